@@ -3,13 +3,49 @@
 """
 Configura automaticamente o ambiente de desenvolvimento para os projetos sigma
 e sigmalib.
+
+Também pode ser utilizado como biblioteca, executando somente alguns passos:
+
+    from prepdev import Prepdev
+    results = Prepdev(repository_path="~/repository", batch=True,
+                      answers=["populate_db=s"]).run_steps(
+        only=["populate_db", "make_commands"])
+
+Como na linha de comando, run_steps grava os logs, o trace e o histórico da
+execução em .prepdevcache.
 """
 
 import subprocess
 import os
 import sys
+import time
+import hashlib
+import random
+import uuid
+import datetime
+import json
+import functools
+import threading
+import sqlite3
+import socket
+import math
+import shutil
+import select
+import pty
+import struct
+import ctypes
+import ctypes.util
+import gzip
+import signal
+import re
+from collections import deque
+from collections import OrderedDict
+from collections import namedtuple
 import configparser
 from tempfile import NamedTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+from concurrent.futures import FIRST_COMPLETED
 import getpass
 import platform
 import grp
@@ -29,6 +65,15 @@ class Colors:
 try:
     import apt
 except ImportError:
+    # Sem o apt o prepdev ainda pode ser importado como biblioteca. A falta
+    # do módulo só é um erro ao executar o script ou verificar os pacotes.
+    apt = None
+
+
+def print_apt_not_found():
+    """
+    Explica como corrigir a falta do módulo apt.
+    """
     msg = Colors.WARNING + Colors.BOLD + "O módulo "
     msg += Colors.BLUE + "apt" + Colors.ENDC + Colors.WARNING + Colors.BOLD
     msg += " não foi encontrado."
@@ -41,7 +86,42 @@ except ImportError:
     msg += "exclua o diretório do seu ambiente virtual e execute novamente."
     msg += Colors.ENDC
     print(msg)
-    sys.exit(-1)
+
+# Versão mínima do python suportada(python3 do debian jessie, a imagem base
+# padrão do --export-container).
+MIN_PYTHON = (3, 4)
+
+# Componentes de um script sql usados por split_sql.
+SQL_TOKEN = re.compile(r"'(?:[^']|'')*'|--[^\n]*|(\$\w*\$).*?\1|;|"
+                       r"[^';$-]+|.", re.DOTALL)
+SQL_COPY_FROM_STDIN = re.compile(r"(?:\s|--[^\n]*)*COPY\b[^;]*\bFROM\s+"
+                                 r"STDIN\b", re.IGNORECASE)
+SQL_COPY_END = re.compile(r"^\\\.[ \t]*(?:\n|$)", re.MULTILINE)
+
+# Passos em execução e comandos executados por cada passo. Permitem
+# reproduzir o provisionamento fora do prepdev(ver export_container).
+STEP_STACK = []
+COMMAND_LOG = []
+# Processos em execução por call() e pela carga paralela, amostrados pelo
+# ResourceSampler. Só é alterado/lido com PROCESS_LOCK(a carga paralela
+# executa vários ao mesmo tempo).
+PROCESS_STACK = []
+PROCESS_LOCK = threading.Lock()
+
+def traced(method):
+    """
+    Registra a duração de um passo do prepdev no trace da execução.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        start = time.time()
+        STEP_STACK.append(method.__name__)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            STEP_STACK.pop()
+            self.record_trace(method.__name__, start, time.time())
+    return wrapper
 
 INTERPOLATION_VALUES = {
     "schemas": {
@@ -67,10 +147,645 @@ class GitHubNotConfiguredError(Exception):
     pass
 
 
+class DatabaseNotReadyError(Exception):
+    pass
+
+
+class MissingAnswerError(Exception):
+    pass
+
+
+class InvalidStepError(Exception):
+    pass
+
+
+class AptNotFoundError(Exception):
+    pass
+
+
+# Resultado de um passo executado por Prepdev.run_steps.
+# status: "ok" ou "skipped"; value: o retorno do passo.
+StepResult = namedtuple("StepResult", ["step", "status", "reason",
+                                       "duration", "value"])
+
+
+class MigrationProfiler(threading.Thread):
+    """
+    Mede a duração de cada migração enquanto o executor de migrações roda.
+
+    As migrações são identificadas pela saída do executor(feed): o alembic
+    registra "Running upgrade <anterior> -> <revisão>" ao iniciar cada
+    revisão, mesmo quando todas são executadas em uma única transação(que
+    esconde as versões intermediárias da tabela de versões). Sem essas
+    linhas a execução inteira é registrada com a versão final da tabela de
+    versões. O comando mais demorado visto em pg_stat_activity durante cada
+    migração também é registrado(uma consulta a cada interval segundos).
+    """
+    interval = 1
+    version_tables = ["alembic_version", "migrate_version"]
+    # alembic: "Running upgrade a1 -> b2, msg"; sqlalchemy-migrate: "1 -> 2..."
+    upgrade_line = re.compile(r"Running upgrade\s+\S*\s+->\s+([^\s,]+)|"
+                              r"^\s*\d+\s+->\s+(\d+)\.\.\.")
+
+    def __init__(self, database):
+        super().__init__(daemon=True)
+        self.database = database
+        self.migrations = []
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._version = None
+        self._version = self._current_version()
+        self._revision = None
+        self._start = time.time()
+        self._statement = ("", 0)
+
+    def _current_version(self):
+        try:
+            return migration_version(self.database, self.version_tables)
+        except (subprocess.CalledProcessError, OSError):
+            return self._version
+
+    def _sample_statement(self):
+        sql = "SELECT extract(epoch FROM now() - query_start), query "
+        sql += "FROM pg_stat_activity WHERE datname = current_database() "
+        sql += "AND state = 'active' AND pid <> pg_backend_pid() "
+        sql += "ORDER BY query_start LIMIT 1"
+        try:
+            output = query(sql, self.database, quiet=True)
+        except subprocess.CalledProcessError:
+            return
+        if output:
+            elapsed, statement = output.split("|", 1)
+            if float(elapsed) >= self._statement[1]:
+                self._statement = (statement, float(elapsed))
+
+    def _close(self, name):
+        now = time.time()
+        self.migrations.append({"name": name,
+                                "start": self._start,
+                                "end": now,
+                                "duration": now - self._start,
+                                "statement": self._statement[0]})
+        self._start = now
+        self._statement = ("", 0)
+
+    def feed(self, line):
+        """
+        Recebe uma linha da saída do executor de migrações.
+        """
+        match = self.upgrade_line.search(line)
+        if match is None:
+            return
+        with self._lock:
+            if self._revision is not None:
+                self._close(self._revision)
+            else:
+                # A inicialização do executor não pertence a nenhuma revisão.
+                self._start = time.time()
+                self._statement = ("", 0)
+            self._revision = match.group(1) or match.group(2)
+
+    def mark(self, name):
+        """
+        Encerra a migração corrente com o nome informado.
+        """
+        with self._lock:
+            self._close(name)
+            self._revision = None
+            self._version = self._current_version()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                self._sample_statement()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        with self._lock:
+            if self._revision is not None:
+                self._close(self._revision)
+                self._revision = None
+                return
+            version = self._current_version()
+            if version != self._version:
+                self._close(version)
+
+
+class StatementProfiler():
+    """
+    Coleta os comandos sql mais demorados através do pg_stat_statements.
+
+    Quando a extensão não está instalada no banco, ou não pode ser usada
+    (ex.: fora do shared_preload_libraries), nada é coletado.
+    """
+    limit = 10
+
+    def __init__(self, database):
+        self.database = database
+        self.time_column = ""
+        sql = "SELECT attname FROM pg_attribute WHERE attrelid = "
+        sql += "to_regclass('pg_stat_statements') AND attname IN "
+        sql += "('total_exec_time', 'total_time')"
+        try:
+            self.time_column = query(sql, self.database, quiet=True)
+        except (subprocess.CalledProcessError, OSError):
+            pass
+
+    def reset(self):
+        if not self.time_column:
+            return
+        try:
+            query("SELECT pg_stat_statements_reset()", self.database,
+                  quiet=True)
+        except (subprocess.CalledProcessError, OSError):
+            self.time_column = ""
+
+    def hotspots(self):
+        """
+        Retorna os comandos que mais consumiram tempo desde o reset.
+        """
+        if not self.time_column:
+            return []
+        sql = "SELECT round(({0} / 1000)::numeric, 3), calls, "
+        sql += "regexp_replace(query, '\\s+', ' ', 'g') "
+        sql += "FROM pg_stat_statements ORDER BY {0} DESC LIMIT {1}"
+        sql = sql.format(self.time_column, self.limit)
+        try:
+            output = query(sql, self.database, quiet=True)
+        except (subprocess.CalledProcessError, OSError):
+            return []
+        hotspots = []
+        for line in output.splitlines():
+            seconds, calls, statement = line.split("|", 2)
+            hotspots.append({"seconds": float(seconds),
+                             "calls": int(calls),
+                             "query": statement})
+        return hotspots
+
+
+class EnvironmentProbe():
+    """
+    Coleta e mantém em cache os fatos do ambiente(versões, grupos, etc).
+
+    Cada fato é guardado junto com o mtime dos arquivos de onde foi extraído.
+    Enquanto esses arquivos não mudarem o fato é lido do cache, sem refazer
+    a descoberta.
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.facts = {}
+        self._changed = False
+        self._lock = threading.Lock()
+        try:
+            with open(self.cache_file, "r") as cache:
+                self.facts = json.load(cache)
+        except (OSError, ValueError):
+            pass
+
+    def _key(self, paths):
+        key = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                key.append([path, stat.st_mtime_ns, stat.st_size])
+            except OSError:
+                key.append([path, None, None])
+        return key
+
+    def get(self, name, paths, function):
+        """
+        Retorna o fato name, executando function somente se algum dos
+        arquivos em paths mudou desde a última coleta.
+        """
+        key = self._key(paths)
+        with self._lock:
+            cached = self.facts.get(name)
+            if cached is not None and cached["key"] == key:
+                return cached["value"]
+        value = function()
+        with self._lock:
+            self.facts[name] = {"key": key, "value": value}
+            self._changed = True
+        return value
+
+    def gather(self, probes):
+        """
+        Coleta em paralelo os fatos de probes({nome: (paths, função)}).
+        """
+        with ThreadPoolExecutor(max_workers=len(probes) or 1) as executor:
+            jobs = {name: executor.submit(self.get, name, paths, function)
+                    for name, (paths, function) in probes.items()}
+        return {name: job.result() for name, job in jobs.items()}
+
+    def save(self):
+        if self._changed is False:
+            return
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        write_atomic(self.cache_file, json.dumps(self.facts))
+        self._changed = False
+
+
+class DirectoryWatcher():
+    """
+    Observa alterações nos arquivos de diretórios(e subdiretórios).
+
+    Utiliza o inotify do kernel através da libc. Quando o inotify não está
+    disponível compara periodicamente o mtime dos arquivos.
+    """
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_ISDIR = 0x40000000
+    poll_interval = 1
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.watches = {}
+        self.fd = -1
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c"),
+                                    use_errno=True)
+            self.fd = self.libc.inotify_init()
+        except (OSError, AttributeError):
+            pass
+        if self.fd >= 0:
+            for path in paths:
+                for root, _, _ in os.walk(path):
+                    self._add_watch(root)
+        else:
+            self.mtimes = self._scan()
+
+    def _add_watch(self, path):
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO
+        mask |= self.IN_CREATE | self.IN_DELETE
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd >= 0:
+            self.watches[wd] = path
+
+    def _scan(self):
+        mtimes = {}
+        for path in self.paths:
+            for root, _, files in os.walk(path):
+                for name in files:
+                    filename = os.path.join(root, name)
+                    try:
+                        mtimes[filename] = os.stat(filename).st_mtime_ns
+                    except OSError:
+                        pass
+        return mtimes
+
+    def _read_events(self):
+        changed = set()
+        buffer = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = struct.unpack_from("iIII", buffer, offset)
+            offset += struct.calcsize("iIII")
+            name = buffer[offset:offset + length].rstrip(b"\0")
+            offset += length
+            path = os.path.join(self.watches.get(wd, ""), os.fsdecode(name))
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self._add_watch(path)
+            else:
+                changed.add(path)
+        return changed
+
+    def changes(self, debounce):
+        """
+        Aguarda alterações e retorna os arquivos alterados.
+
+        Retorna somente após debounce segundos sem novas alterações.
+        """
+        if self.fd < 0:
+            while True:
+                time.sleep(self.poll_interval)
+                mtimes = self._scan()
+                changed = {path for path in set(mtimes) | set(self.mtimes)
+                           if mtimes.get(path) != self.mtimes.get(path)}
+                self.mtimes = mtimes
+                if changed:
+                    return changed
+        select.select([self.fd], [], [])
+        changed = self._read_events()
+        while select.select([self.fd], [], [], debounce)[0]:
+            changed |= self._read_events()
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class OutputCapture():
+    """
+    Captura a saída dos comandos executados por call().
+
+    A saída de cada passo é gravada, comprimida, em <diretório>/<passo>.log.gz
+    e as últimas ring_size linhas ficam em memória para o resumo de erros. A
+    vazão(linhas e bytes por segundo) de cada comando é registrada e um
+    comando sem saída por stall_timeout segundos é apontado enquanto executa.
+
+    tail e metrics são compartilhados entre threads(ex.: carga paralela) e
+    só são alterados com o lock.
+    """
+    ring_size = 50
+    stall_timeout = 30
+    keep_runs = 10
+    kill_grace = 5
+
+    def __init__(self):
+        self.directory = None
+        self.tail = deque(maxlen=self.ring_size)
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def start(self, base_directory):
+        """
+        Inicia a captura desta execução, mantendo as keep_runs mais recentes.
+        """
+        os.makedirs(base_directory, exist_ok=True)
+        runs = sorted(os.listdir(base_directory))
+        for old_run in runs[:max(len(runs) - self.keep_runs + 1, 0)]:
+            shutil.rmtree(os.path.join(base_directory, old_run),
+                          ignore_errors=True)
+        name = time.strftime("%Y%m%d-%H%M%S")
+        self.directory = os.path.join(base_directory, name)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def capture(self, process, fd, step, command, echo=False, timeout=None,
+                kill_after=None, on_line=None):
+        """
+        Lê a saída de process(no descritor fd) até o fim e retorna as
+        métricas e as últimas linhas da saída do comando. Cada linha lida é
+        repassada a on_line(quando informado).
+
+        O processo(e seus filhos) é encerrado quando ultrapassa timeout
+        segundos ou fica kill_after segundos sem produzir saída: recebe
+        SIGTERM e, se continuar executando após kill_grace segundos, SIGKILL.
+        """
+        tail = deque(maxlen=self.ring_size)
+        log_file = None
+        if self.directory is not None:
+            path = os.path.join(self.directory, (step or "prepdev") + ".log.gz")
+            log_file = gzip.open(path, "ab")
+            log_file.write("$ {}\n".format(command).encode("utf-8"))
+        start = last_output = time.monotonic()
+        total_bytes = total_lines = 0
+        partial = b""
+        stalled = False
+        killed = None
+        while True:
+            ready = select.select([fd], [], [], 1)[0]
+            now = time.monotonic()
+            expired = timeout is not None and now - start >= timeout
+            idle = now - last_output
+            if kill_after is not None and idle >= kill_after:
+                expired = True
+            if expired is True and killed is None:
+                msg = "Encerrando após {}s({}s sem saída): {}"
+                print_warning(msg.format(int(now - start), int(idle), command))
+                kill_tree(process.pid, signal.SIGTERM)
+                killed = now
+            elif killed is not None and now - killed >= self.kill_grace:
+                kill_tree(process.pid, signal.SIGKILL)
+            if not ready:
+                if idle >= self.stall_timeout and stalled is False:
+                    msg = "Nenhuma saída há {}s: {}".format(int(idle), command)
+                    print_warning(msg)
+                    stalled = True
+                continue
+            try:
+                data = os.read(fd, 65536)
+            except OSError:
+                # Fim da saída em um pseudo-terminal.
+                data = b""
+            if not data:
+                break
+            last_output = time.monotonic()
+            stalled = False
+            total_bytes += len(data)
+            total_lines += data.count(b"\n")
+            if echo is True:
+                sys.stdout.buffer.write(data)
+                sys.stdout.flush()
+            if log_file is not None:
+                log_file.write(data)
+            lines = (partial + data).split(b"\n")
+            partial = lines.pop()
+            for line in lines:
+                line = line.decode("utf-8", "replace").rstrip("\r")
+                tail.append(line)
+                if on_line is not None:
+                    on_line(line)
+        if partial:
+            partial = partial.decode("utf-8", "replace").rstrip("\r")
+            tail.append(partial)
+            if on_line is not None:
+                on_line(partial)
+        if log_file is not None:
+            log_file.close()
+        seconds = max(time.monotonic() - start, 0.001)
+        metrics = {"step": step,
+                   "command": command,
+                   "seconds": seconds,
+                   "bytes": total_bytes,
+                   "lines": total_lines,
+                   "bytes_per_second": total_bytes / seconds,
+                   "lines_per_second": total_lines / seconds,
+                   "killed": killed is not None}
+        with self._lock:
+            self.tail = tail
+            self.metrics.append(metrics)
+        return metrics, tail
+
+    def record(self, step, command, output, seconds):
+        """
+        Registra a saída de um comando executado fora de call().
+        """
+        tail = deque(output.decode("utf-8", "replace").splitlines(),
+                     maxlen=self.ring_size)
+        if self.directory is not None:
+            path = os.path.join(self.directory, (step or "prepdev") + ".log.gz")
+            with gzip.open(path, "ab") as log_file:
+                log_file.write("$ {}\n".format(command).encode("utf-8"))
+                log_file.write(output)
+        seconds = max(seconds, 0.001)
+        lines = output.count(b"\n")
+        metrics = {"step": step,
+                   "command": command,
+                   "seconds": seconds,
+                   "bytes": len(output),
+                   "lines": lines,
+                   "bytes_per_second": len(output) / seconds,
+                   "lines_per_second": lines / seconds,
+                   "killed": False}
+        with self._lock:
+            self.tail = tail
+            self.metrics.append(metrics)
+
+    def save_metrics(self):
+        with self._lock:
+            metrics = list(self.metrics)
+        if self.directory is None or not metrics:
+            return
+        with open(os.path.join(self.directory, "metrics.json"), "w") as file_:
+            json.dump(metrics, file_, indent=2)
+
+
+class ResourceSampler(threading.Thread):
+    """
+    Amostra o uso de recursos dos comandos executados por call() e pela carga
+    paralela dos dados.
+
+    A cada interval segundos lê em /proc as árvores de processos dos
+    comandos em execução(cpu, rss, estado e bytes de disco), os bytes de rede
+    da máquina e as sessões ativas em pg_stat_activity. As amostras são
+    somadas por passo e cada passo recebe o recurso que mais o segurou:
+    network, cpu, io ou db.
+    """
+    interval = 0.5
+    # Fração mínima das amostras para atribuir um gargalo ao passo.
+    min_share = 0.2
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.steps = OrderedDict()
+        self._stopped = threading.Event()
+        self._counters = {}
+        self._network = None
+        self._clock_ticks = os.sysconf("SC_CLK_TCK")
+        self._page_size = os.sysconf("SC_PAGE_SIZE")
+
+    def _io_bytes(self, pid):
+        try:
+            with open("/proc/{}/io".format(pid)) as file_:
+                io = dict(line.split(": ") for line in file_.read().split("\n")
+                          if ": " in line)
+        except OSError:
+            # Processos de outro usuário(sudo) não expõem o io.
+            return 0
+        return int(io["read_bytes"]) + int(io["write_bytes"])
+
+    def _network_bytes(self):
+        total = 0
+        with open("/proc/net/dev") as file_:
+            for line in file_.readlines()[2:]:
+                interface, data = line.split(":", 1)
+                if interface.strip() != "lo":
+                    fields = data.split()
+                    total += int(fields[0]) + int(fields[8])
+        return total
+
+    def _database_active(self):
+        sql = "SELECT count(*) FROM pg_stat_activity WHERE state = 'active' "
+        sql += "AND pid <> pg_backend_pid()"
+        try:
+            return int(query(sql, quiet=True) or 0)
+        except (subprocess.CalledProcessError, OSError, ValueError):
+            return 0
+
+    def _sample(self, step):
+        totals = self.steps.setdefault(step, {"samples": 0,
+                                              "cpu_seconds": 0.0,
+                                              "rss_peak_kb": 0,
+                                              "io_bytes": 0,
+                                              "network_bytes": 0,
+                                              "running": 0,
+                                              "io_wait": 0,
+                                              "network_wait": 0,
+                                              "db_active": 0})
+        network = self._network_bytes()
+        network_delta = network - (self._network or network)
+        self._network = network
+        totals["samples"] += 1
+        totals["network_bytes"] += network_delta
+        with PROCESS_LOCK:
+            pids = list(PROCESS_STACK)
+        tree = {}
+        for pid in pids:
+            tree.update(process_tree(pid))
+        states = set()
+        rss = 0
+        for child, fields in tree.items():
+            # utime, stime, starttime e rss(campos 14, 15, 22 e 24).
+            key = (child, fields[19])
+            ticks = int(fields[11]) + int(fields[12])
+            io_bytes = self._io_bytes(child)
+            last_ticks, last_io = self._counters.get(key, (0, 0))
+            self._counters[key] = (ticks, io_bytes)
+            totals["cpu_seconds"] += (ticks - last_ticks) / self._clock_ticks
+            totals["io_bytes"] += max(io_bytes - last_io, 0)
+            rss += int(fields[21]) * self._page_size // 1024
+            states.add(fields[0])
+        totals["rss_peak_kb"] = max(totals["rss_peak_kb"], rss)
+        database_active = self._database_active()
+        if database_active > 0:
+            totals["db_active"] += 1
+        if "R" in states:
+            totals["running"] += 1
+        elif "D" in states:
+            totals["io_wait"] += 1
+        elif tree and network_delta > 0 and database_active == 0:
+            # Parado, sem disco e com tráfego: esperando a rede.
+            totals["network_wait"] += 1
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            # Cópia da pilha: o passo pode terminar durante a amostragem.
+            steps = list(STEP_STACK)
+            if steps:
+                self._sample(steps[0])
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def bottleneck(self, step):
+        """
+        Retorna o recurso que mais segurou o passo: network, cpu, io ou db.
+
+        Retorna "" quando nenhum recurso aparece em min_share das amostras.
+        """
+        totals = self.steps[step]
+        shares = {"cpu": totals["running"],
+                  "io": totals["io_wait"],
+                  "network": totals["network_wait"],
+                  "db": totals["db_active"]}
+        resource = max(sorted(shares), key=shares.get)
+        if shares[resource] < totals["samples"] * self.min_share:
+            return ""
+        return resource
+
+    def report(self):
+        """
+        Retorna as amostras somadas de cada passo com o seu gargalo.
+        """
+        report = []
+        for step, totals in self.steps.items():
+            entry = {"step": step, "bottleneck": self.bottleneck(step)}
+            entry.update(totals)
+            report.append(entry)
+        return report
+
+
+OUTPUT_CAPTURE = OutputCapture()
+
+
 class Prepdev():
     positive_answer = ["s", "S", "y", "Y", "sim", "Sim", "SIM"]
     local_repository = ""
     venv = ".sigmavenv"
+    shims = ".sigmabin"
+    shims_path = ""
+    venv_commands = ["sigma_server", "sigma_run_migrations", "sigma_run_tests",
+                     "sigma_update_postgres_env", "sigma_update_settings",
+                     "sigma_update_static"]
     sigma_path = ""
     sigmalib_path = ""
     venv_path = ""
@@ -87,6 +802,8 @@ class Prepdev():
     sigma_pub_key = sigma_ssh_key + ".pub"
     sigmalib_pub_key = sigmalib_ssh_key + ".pub"
     bashrc = os.path.join(home_dir, ".bashrc")
+    bashrc_begin = "# >>> prepdev >>>"
+    bashrc_end = "# <<< prepdev <<<"
     url_sigmalib = "git@sigmalib.github.com:ativasistemas/sigmalib.git"
     url_sigma = "git@sigma.github.com:ativasistemas/sigma.git"
     min_postgres_version = "9.4"
@@ -99,23 +816,113 @@ class Prepdev():
     postgres_cluster = ""
     postgres_version = ""
     postgres_pghba = ""
+    postgres_environment = "/tmp/environment"
+    postgres_ready_timeout = 60
+    test_ini_file = "/tmp/sigma_test_{}.ini"
+    regression_min_runs = 3
+    doctor_timeout = 2
+    # O apt.cache.Cache() pode levar vários segundos para carregar.
+    doctor_apt_timeout = 30
+    drain_timeout = 10
+    tuning_file_name = "90-prepdev-tuning.conf"
+    reload_timeout = 5
+    fetch_timeout = 60
+    network_attempts = 3
+    network_backoff = 2
+    network_timeout_factor = 3
+    network_min_timeout = 60
+    network_max_timeout = 1800
+    network_kill_after = 120
+    container_root = "/opt/sigma"
+    watch_debounce = 0.5
+    max_seed_jobs = 4
+    report_steps = ["print_help", "print_stats"]
+    # Passos que usam o cluster do postgresql(e podem perguntar qual usar).
+    postgresql_steps = ["configure_postgresql", "prepare_database",
+                        "tune_postgresql", "untune_postgresql"]
+    generate_attempts = 10
+    seed_manifest = "manifest.ini"
+    # sudo como comando(início ou após &&, ||, ; e |).
+    sudo_command = re.compile(r"(?:^|[;&|]\s*)sudo\s")
+    seed_statement = re.compile(r"(INSERT\s+INTO|COPY|UPDATE|DELETE\s+FROM)"
+                                r"\s+(?:ONLY\s+)?([\w.\"]+)", re.IGNORECASE)
+    seed_control = re.compile(r"(BEGIN|COMMIT|SET)\b", re.IGNORECASE)
+    seed_reads = re.compile(r"\b(SELECT|WITH|FROM|USING|JOIN|RETURNING|"
+                            r"TABLE)\b|\\", re.IGNORECASE)
+    seed_copy_from = re.compile(r"\bFROM\s+STDIN\b.*", re.IGNORECASE |
+                                re.DOTALL)
+    seed_copy_data = re.compile(r"(FROM\s+stdin[^;]*;[ \t]*\n).*?^\\\.$",
+                                re.IGNORECASE | re.MULTILINE | re.DOTALL)
 
     def __init__(self,
                  resetdb=False,
                  excludedb=False,
                  close_connections=False,
                  repository_path="",
-                 sigma_help=False):
+                 sigma_help=False,
+                 test_databases=0,
+                 drop_test_databases=False,
+                 reset_schema="",
+                 data_scale=0,
+                 stats=False,
+                 regression_threshold=1.5,
+                 show_plan=False,
+                 run_doctor=False,
+                 batch=False,
+                 answers_file="",
+                 answers=None,
+                 export_dir="",
+                 base_image="debian:jessie",
+                 watch=False,
+                 only=None,
+                 skip=None,
+                 tune_postgresql=False,
+                 untune_postgresql=False,
+                 bundle_dir="",
+                 bundles_output="",
+                 sample_resources=False,
+                 seed_jobs=1,
+                 defer_constraints=False,
+                 prewarm=False):
         self.base_path = os.path.dirname(os.path.abspath(__file__))
         self.prepdevrc = os.path.join(self.base_path, ".prepdevrc")
+        self.cache_dir = os.path.join(self.base_path, ".prepdevcache")
         self._create_config_file(self.ini_file)
         self.resetdb = resetdb
         self.excludedb = excludedb
         self.close_connections = close_connections
         self.repository_path = repository_path
         self.sigma_help = sigma_help
+        self.test_databases = test_databases
+        self.drop_test_databases = drop_test_databases
+        self.reset_schema = reset_schema
+        self.data_scale = data_scale
+        self.stats = stats
+        self.regression_threshold = regression_threshold
+        self.show_plan = show_plan
+        self.run_doctor = run_doctor
+        self.batch = batch
+        self.export_dir = export_dir
+        self.base_image = base_image
+        self.watch_files = watch
+        self.only = only or []
+        self.skip = skip or []
+        self.tune = tune_postgresql
+        self.untune = untune_postgresql
+        self.bundle_dir = os.path.expanduser(bundle_dir)
+        self.bundles_output = os.path.expanduser(bundles_output)
+        self.sample_resources = sample_resources
+        self.seed_jobs = seed_jobs
+        self.defer_constraints = defer_constraints
+        self.prewarm = prewarm
+        self.answers = self._load_answers(answers_file, answers or [])
+        if self.repository_path == "" and "repository_path" in self.answers:
+            self.repository_path = self.answers["repository_path"]
+        if self.excludedb is True:
+            self.answers["drop_database"] = "s"
         # Alguns pacotes mudam de nome quando a arquitetura muda.
         # Aqui cuidamos desse detalhe.
+        self.packages = list(self.packages)
         if platform.architecture()[0] == "64bit":
             self.packages.append("lib32z1-dev")
         else:
@@ -129,19 +936,462 @@ class Prepdev():
                           "user_importacao": self.config["sigma:database:users:importacao"]["name"],
                           "group_importacao": self.config["sigma:database:groups:importacao"]["name"]}
 
-        self.disconnect_db_command = "\"SELECT pg_terminate_backend(pid) FROM "
-        self.disconnect_db_command += "pg_stat_get_activity(NULL::integer) WHERE datid=("
-        self.disconnect_db_command += "SELECT oid from pg_database where datname = '{}');\"".format(self.database_name)
         self.current_user =  getpass.getuser()
+        self.trace = []
+        self.trace_file = os.path.join(self.cache_dir, "trace.json")
+        self.history_file = os.path.join(self.cache_dir, "history.sqlite")
+        self.metrics_file = os.path.join(self.cache_dir, "prepdev.prom")
+        self.commands_file = os.path.join(self.cache_dir, "commands.json")
+        self.started = time.time()
+        self._statistics = None
+        self.probe = EnvironmentProbe(os.path.join(self.cache_dir,
+                                                   "probe.json"))
+
+    def record_trace(self, step, start, end, **details):
+        """
+        Acrescenta uma entrada ao trace da execução.
+        """
+        entry = {"step": step, "start": start, "end": end,
+                 "duration": end - start}
+        entry.update(details)
+        self.trace.append(entry)
+
+    def save_trace(self, executed=()):
+        """
+        Grava o trace da execução no cache do prepdev.
+
+        Os comandos dos passos executados(executed) substituem, no
+        commands.json, os gravados anteriormente para esses passos.
+        """
+        if not self.trace:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.trace_file, "w") as trace_file:
+            json.dump(self.trace, trace_file, indent=2)
+        if self._mode() == "full" and executed:
+            self._save_commands(executed)
+        try:
+            self.save_history()
+            self.export_metrics()
+        except (sqlite3.Error, OSError) as exc:
+            # Não esconde o erro que interrompeu a execução.
+            msg = "Não foi possível gravar o histórico: {}"
+            print_warning(msg.format(exc))
+
+    def _save_commands(self, executed):
+        """
+        Atualiza os comandos gravados dos passos executados.
+
+        Uma execução parcial(--only/--skip) mantém os comandos dos demais
+        passos, usados pelo --export-container.
+        """
+        recorded = {"commands": []}
+        if os.path.exists(self.commands_file) is True:
+            with open(self.commands_file, "r") as commands_file:
+                recorded = json.load(commands_file)
+        commands = [entry for entry in recorded["commands"]
+                    if entry["step"] not in executed]
+        commands += [entry for entry in COMMAND_LOG
+                     if entry["step"] in executed]
+        order = self._steps()
+        commands.sort(key=lambda entry: order.index(entry["step"])
+                      if entry["step"] in order else len(order))
+        recorded.update({"local_repository": self.local_repository,
+                         "packages": self.packages,
+                         "commands": commands})
+        write_atomic(self.commands_file, json.dumps(recorded, indent=2))
+
+    def _mode(self):
+        """
+        Retorna o nome do modo de execução escolhido na linha de comando.
+        """
+        if self.run_doctor is True:
+            return "doctor"
+        return self._mode_steps()[0]
+
+    def _host_facts(self):
+        """
+        Retorna as características da máquina que influenciam os tempos.
+        """
+        facts = {"host": socket.gethostname(),
+                 "cpus": os.cpu_count(),
+                 "platform": platform.platform(),
+                 "python": platform.python_version(),
+                 "postgresql": self.postgres_cluster,
+                 "memory_kb": memory_kb()}
+        if self.postgres_cluster != "":
+            facts["postgresql_tuning"] = os.path.exists(self._tuning_file())
+        return facts
+
+    def _input_fingerprints(self):
+        """
+        Retorna o hash das entradas que alteram o trabalho de cada passo.
+        """
+        if self.sigma_path == "":
+            return {}
+        inputs = {"setup": [os.path.join(self.sigma_path, "setup.py"),
+                            os.path.join(self.sigmalib_path, "setup.py")],
+                  "migrations": [],
+                  "seed": self._seed_files()}
+        migrations = os.path.join(self.sigma_path, "sigma", "migrations")
+        for root, _, files in os.walk(migrations):
+            inputs["migrations"] += [os.path.join(root, f) for f in files]
+        fingerprints = {}
+        for name, paths in inputs.items():
+            digest = hashlib.sha256()
+            for path in sorted(paths):
+                if os.path.isfile(path):
+                    digest.update(path.encode("utf-8"))
+                    digest.update(file_hash(path).encode("utf-8"))
+            fingerprints[name] = digest.hexdigest()[:16]
+        return fingerprints
+
+    def _history(self):
+        """
+        Abre(criando caso necessário) o histórico de execuções.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        connection = sqlite3.connect(self.history_file)
+        connection.execute("CREATE TABLE IF NOT EXISTS runs ("
+                           "id INTEGER PRIMARY KEY, started REAL, mode TEXT, "
+                           "facts TEXT, fingerprints TEXT)")
+        connection.execute("CREATE TABLE IF NOT EXISTS steps ("
+                           "run_id INTEGER REFERENCES runs(id), step TEXT, "
+                           "duration REAL)")
+        return connection
+
+    def save_history(self):
+        """
+        Acrescenta a duração dos passos desta execução ao histórico.
+        """
+        with self._history() as connection:
+            cursor = connection.execute(
+                "INSERT INTO runs (started, mode, facts, fingerprints) "
+                "VALUES (?, ?, ?, ?)",
+                (self.started, self._mode(), json.dumps(self._host_facts()),
+                 json.dumps(self._input_fingerprints())))
+            run_id = cursor.lastrowid
+            steps = []
+            for entry in self.trace:
+                step = entry["step"]
+                if step == "migration":
+                    step = "migration:{}".format(entry["migration"])
+                elif step in ["network", "network_failure"]:
+                    step = "{}:{}".format(step, entry["operation"])
+                steps.append((run_id, step, entry["duration"]))
+            connection.executemany("INSERT INTO steps VALUES (?, ?, ?)", steps)
+        connection.close()
+
+    def step_statistics(self, mode=None):
+        """
+        Calcula as estatísticas de duração de cada passo.
+
+        Somente as execuções do mesmo modo(por padrão o desta execução) são
+        comparadas. Retorna um dicionário {passo: estatísticas}, onde last é
+        a duração do passo na execução mais recente que o executou. Um passo
+        regrediu quando ele faz parte da execução mais recente e sua duração
+        supera regression_threshold vezes a mediana das execuções anteriores.
+        """
+        if os.path.exists(self.history_file) is False:
+            return {}
+        mode = mode or self._mode()
+        connection = self._history()
+        rows = connection.execute("SELECT s.run_id, s.step, sum(s.duration) "
+                                  "FROM steps s "
+                                  "JOIN runs r ON r.id = s.run_id "
+                                  "WHERE r.mode = ? GROUP BY s.run_id, s.step "
+                                  "ORDER BY s.run_id", (mode,)).fetchall()
+        connection.close()
+        if not rows:
+            return {}
+        latest_run = rows[-1][0]
+        durations = {}
+        last_runs = {}
+        for run_id, step, duration in rows:
+            durations.setdefault(step, []).append(duration)
+            last_runs[step] = run_id
+        statistics = {}
+        for step, values in durations.items():
+            previous = values[:-1]
+            regression = False
+            if (last_runs[step] == latest_run and
+                    len(previous) >= self.regression_min_runs):
+                limit = percentile(previous, 0.5) * self.regression_threshold
+                regression = values[-1] > limit
+            statistics[step] = {"runs": len(values),
+                                "p50": percentile(values, 0.5),
+                                "p95": percentile(values, 0.95),
+                                "last": values[-1],
+                                "regression": regression}
+        return statistics
+
+    def print_stats(self):
+        """
+        Imprime as estatísticas do histórico de execuções, por modo.
+        """
+        modes = self._history_modes()
+        if not modes:
+            print_warning("Nenhuma execução registrada no histórico.")
+            return
+        header = "{:<40} {:>5} {:>9} {:>9} {:>9}"
+        line = "{:<40} {:>5} {:>8.2f}s {:>8.2f}s {:>8.2f}s"
+        for mode in modes:
+            statistics = self.step_statistics(mode)
+            print_info("Modo {}:".format(mode), bold=True)
+            print_info(header.format("passo", "runs", "p50", "p95",
+                                     "última"), bold=True)
+            for step in sorted(statistics):
+                stat = statistics[step]
+                msg = line.format(step[:40], stat["runs"], stat["p50"],
+                                  stat["p95"], stat["last"])
+                if stat["regression"] is True:
+                    print_error(msg + " (regressão)", bold=True)
+                else:
+                    print_blue(msg)
+        self.print_tuning_comparison()
+        self.export_metrics()
+        print_info("Métricas exportadas em {}".format(self.metrics_file))
+
+    def _history_modes(self):
+        """
+        Retorna os modos com execuções no histórico, do mais recente ao mais
+        antigo. Os modos que só exibem informações não são comparados.
+        """
+        if os.path.exists(self.history_file) is False:
+            return []
+        connection = self._history()
+        rows = connection.execute("SELECT mode FROM runs WHERE mode NOT IN "
+                                  "('sigma_help', 'stats', 'doctor') "
+                                  "GROUP BY mode "
+                                  "ORDER BY max(id) DESC").fetchall()
+        connection.close()
+        return [row[0] for row in rows]
+
+    def print_tuning_comparison(self):
+        """
+        Compara a carga do banco antes e depois do perfil de tuning.
+
+        Usa as execuções do histórico, separadas pela presença do perfil
+        (--tune-postgresql) no momento da execução.
+        """
+        connection = self._history()
+        rows = connection.execute("SELECT s.step, s.duration, r.facts "
+                                  "FROM steps s JOIN runs r ON r.id = s.run_id "
+                                  "WHERE s.step IN ('run_migrations', "
+                                  "'populate_db')").fetchall()
+        connection.close()
+        durations = {}
+        for step, duration, facts in rows:
+            tuned = json.loads(facts).get("postgresql_tuning")
+            if tuned is not None:
+                durations.setdefault((step, tuned), []).append(duration)
+        for step in ["run_migrations", "populate_db"]:
+            before = durations.get((step, False))
+            after = durations.get((step, True))
+            if before and after:
+                before = percentile(before, 0.5)
+                after = percentile(after, 0.5)
+                msg = "{}: {} sem tuning, {} com tuning ({:+.0%})"
+                print_info(msg.format(step, format_duration(before),
+                                      format_duration(after),
+                                      (after - before) / before))
+
+    def print_resource_report(self, report):
+        """
+        Imprime o uso de recursos e o gargalo de cada passo amostrado.
+
+        O relatório também é gravado em resources.json junto dos logs da
+        execução.
+        """
+        if not report:
+            return
+        if OUTPUT_CAPTURE.directory is not None:
+            path = os.path.join(OUTPUT_CAPTURE.directory, "resources.json")
+            with open(path, "w") as file_:
+                json.dump(report, file_, indent=2)
+        header = "{:<30} {:>8} {:>9} {:>9} {:>10} {:>10} {:>6}"
+        print_info(header.format("passo", "gargalo", "cpu", "rss", "disco",
+                                 "rede", "db"), bold=True)
+        line = "{:<30} {:>8} {:>8.1f}s {:>7}MB {:>8}MB {:>8}MB {:>5.0%}"
+        for entry in report:
+            print_blue(line.format(entry["step"][:30],
+                                   entry["bottleneck"] or "-",
+                                   entry["cpu_seconds"],
+                                   entry["rss_peak_kb"] // 1024,
+                                   entry["io_bytes"] // 2 ** 20,
+                                   entry["network_bytes"] // 2 ** 20,
+                                   entry["db_active"] / entry["samples"]))
+
+    def export_metrics(self):
+        """
+        Exporta as estatísticas de cada modo no formato textfile do
+        OpenMetrics.
+
+        O arquivo é substituído atomicamente para que o coletor nunca leia um
+        arquivo pela metade.
+        """
+        statistics = {mode: self.step_statistics(mode)
+                      for mode in self._history_modes()}
+        lines = ["# HELP prepdev_step_duration_seconds Duração dos passos "
+                 "do prepdev.",
+                 "# TYPE prepdev_step_duration_seconds gauge"]
+        # quantile é reservado aos summaries do OpenMetrics.
+        metric = "prepdev_step_duration_seconds"
+        metric += '{{mode="{}",step="{}",percentile="{}"}} {}'
+        for mode in sorted(statistics):
+            for step in sorted(statistics[mode]):
+                stat = statistics[mode][step]
+                lines.append(metric.format(mode, step, "0.5", stat["p50"]))
+                lines.append(metric.format(mode, step, "0.95", stat["p95"]))
+        lines += ["# HELP prepdev_step_last_duration_seconds Duração do "
+                  "passo na última execução.",
+                  "# TYPE prepdev_step_last_duration_seconds gauge"]
+        metric = 'prepdev_step_last_duration_seconds{{mode="{}",step="{}"}} {}'
+        for mode in sorted(statistics):
+            for step in sorted(statistics[mode]):
+                lines.append(metric.format(mode, step,
+                                           statistics[mode][step]["last"]))
+        lines += ["# HELP prepdev_step_regression Passo com regressão de "
+                  "desempenho.",
+                  "# TYPE prepdev_step_regression gauge"]
+        metric = 'prepdev_step_regression{{mode="{}",step="{}"}} {}'
+        for mode in sorted(statistics):
+            for step in sorted(statistics[mode]):
+                regression = int(statistics[mode][step]["regression"])
+                lines.append(metric.format(mode, step, regression))
+        lines.append("# EOF")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        write_atomic(self.metrics_file, "\n".join(lines) + "\n")
+
+    def _load_answers(self, answers_file, answers):
+        """
+        Carrega as respostas das perguntas do prepdev.
+
+        As respostas vêm da seção [answers] de answers_file e das opções
+        --answer chave=valor, que têm precedência sobre o arquivo.
+        """
+        loaded = {}
+        if answers_file != "":
+            config = configparser.RawConfigParser()
+            if not config.read(answers_file):
+                msg = "Arquivo de respostas {} não encontrado."
+                raise MissingAnswerError(msg.format(answers_file))
+            if "answers" in config:
+                loaded.update(config["answers"])
+        for answer in answers:
+            key, separator, value = answer.partition("=")
+            if separator == "":
+                msg = "Resposta inválida: {}. Use chave=valor."
+                raise MissingAnswerError(msg.format(answer))
+            loaded[key.strip()] = value.strip()
+        return loaded
+
+    def ask(self, key, msg):
+        """
+        Retorna a resposta da pergunta key.
+
+        Quando a resposta não foi informada pergunta ao usuário, exceto no
+        modo não interativo, onde a falta da resposta é um erro.
+        """
+        if key in self.answers:
+            return self.answers[key]
+        if self.batch is True:
+            msg = "A resposta '{}' não foi informada. Inclua-a no arquivo de "
+            msg += "respostas ou use --answer {}=<valor>."
+            raise MissingAnswerError(msg.format(key, key))
+        return input(msg)
+
+    def _choose(self, key, options):
+        """
+        Solicita que o usuário escolha uma das opções listadas.
+
+        Uma resposta informada previamente deve ser o valor de uma das opções
+        (ex.: postgresql_cluster=main), e não o número da opção.
+
+        Retorna None quando a resposta informada não é uma opção válida.
+        """
+        if key in self.answers:
+            if self.answers[key] in options:
+                return self.answers[key]
+            return None
+        while True:
+            msg = "Qual opção você deseja utilizar? "
+            answer = self.ask(key, msg)
+            try:
+                answer = int(answer)
+                if answer > len(options):
+                    raise Exception
+                if answer < 1:
+                    raise Exception
+            except Exception:
+                print_error("Opção inválida.")
+            else:
+                return options[answer-1]
+
+    def _missing_answers(self, steps):
+        """
+        Retorna as respostas que os passos precisarão e não foram informadas.
+        """
+        missing = []
+        if "set_instalation_path" in steps and self.repository_path == "":
+            missing.append("repository_path")
+        if "populate_db" in steps and "populate_db" not in self.answers:
+            missing.append("populate_db")
+        if "prepare_database" in steps and "drop_database" not in self.answers:
+            if self._database_exists() is True:
+                missing.append("drop_database")
+        if any(step in steps for step in self.postgresql_steps):
+            missing += self._missing_postgresql_answers()
+        return missing
+
+    def _missing_postgresql_answers(self):
+        """
+        Retorna as escolhas do postgresql(versão e cluster) que serão
+        perguntadas e não foram informadas.
+
+        Instalações inválidas não são reportadas aqui: o passo que usa o
+        cluster informa o erro.
+        """
+        if self.postgres_cluster != "":
+            return []
+        base = self.postgres_config_base_path
+        try:
+            versions = self.probe.get("postgresql_versions", [base],
+                                      lambda: sorted(os.listdir(base)))
+            if len(versions) > 1:
+                versions = self._valid_postgresql_versions(versions)
+        except (OSError, ValueError, IndexError):
+            return []
+        if len(versions) > 1:
+            version = self.answers.get("postgresql_version")
+            if version is None:
+                return ["postgresql_version"]
+            if version not in versions:
+                return []
+        elif len(versions) == 1:
+            version = versions[0]
+        else:
+            return []
+        path = os.path.join(base, version)
+        try:
+            clusters = self.probe.get("postgresql_clusters:" + path, [path],
+                                      lambda: sorted(os.listdir(path)))
+        except OSError:
+            return []
+        if len(clusters) > 1 and "postgresql_cluster" not in self.answers:
+            return ["postgresql_cluster"]
+        return []
 
     def write_config(self, name, value, section="default"):
         """
         Grava o parâmetro do prepdev no arquivo de configuração.
         """
-        with open(self.prepdevrc, "w") as config_file:
-            config = configparser.RawConfigParser()
+        config = configparser.RawConfigParser()
+        config.read(self.prepdevrc)
+        if section not in config:
             config.add_section(section)
-            config.set(section, name, value)
+        config.set(section, name, value)
+        with open(self.prepdevrc, "w") as config_file:
             config.write(config_file)
 
     def read_config(self, name, section="default"):
@@ -243,16 +1493,34 @@ class Prepdev():
         self.config = configparser.ConfigParser()
         self.config.read(file_)
 
+    @traced
     def so_dependencies(self):
         """
         Instala as dependências do S.O..
         """
         print_info("Instalando dependências do S.O...")
-        cmd = "sudo apt-get install -f -y"
-        for pkg in self.packages:
-            cmd += " {}".format(pkg)
-        call(cmd)
-
+        packages = " ".join(self.packages)
+        cmd = "sudo apt-get install -f -y {}".format(packages)
+        sources = [("apt", cmd)]
+        apt_mirror = self.read_config("apt_mirror", "network")
+        if apt_mirror != "":
+            # Repositório apt local(diretório com o índice Packages).
+            sources_list = "/tmp/prepdev-apt-mirror.list"
+            with open(sources_list, "w") as file_:
+                line = "deb [trusted=yes] file:{} ./\n"
+                file_.write(line.format(apt_mirror))
+            # Índices próprios, para não substituir as listas do sistema.
+            lists = "/tmp/prepdev-apt-lists"
+            options = "-o Dir::Etc::SourceList={} -o Dir::Etc::SourceParts=- "
+            options += "-o Dir::State::Lists={}"
+            options = options.format(sources_list, lists)
+            cmd = "sudo mkdir -p {2}/partial && sudo apt-get {0} update && "
+            cmd += "sudo apt-get {0} install -f -y {1}"
+            sources.append(("apt_mirror",
+                            cmd.format(options, packages, lists)))
+        self._network_call("apt", sources)
+
+    @traced
     def create_venv(self):
         """
         Cria o amebiente virtual.
@@ -276,7 +1544,7 @@ class Prepdev():
             msg = Colors.WARNING
             msg += "Em qual diretório os códigos devem ficar? "
             msg += Colors.BLUE + "({}): ".format(default_dir) + Colors.ENDC
-            answer = input(msg)
+            answer = self.ask("repository_path", msg)
 
             if not answer:
                 answer = default_dir
@@ -287,8 +1555,22 @@ class Prepdev():
             answer = os.path.expanduser(answer)
 
         self.write_config(section, answer)
+        self._set_paths(answer)
+        os.makedirs(self.local_repository, exist_ok=True)
+
+    def _planned_repository_path(self):
+        """
+        Retorna, sem perguntar ao usuário, o diretório que será utilizado.
+        """
+        default_dir = os.path.expanduser("~/repository")
+        path = self.repository_path or self.read_config("repository_path")
+        return os.path.expanduser(path or default_dir)
 
-        self.local_repository = answer
+    def _set_paths(self, local_repository):
+        """
+        Configura os caminhos derivados do diretório dos repositórios.
+        """
+        self.local_repository = local_repository
         self.sigma_path = os.path.join(self.local_repository, "sigma")
         self.sigmalib_path = os.path.join(self.local_repository, "sigmalib")
         self.venv_path = os.path.join(self.local_repository, self.venv)
@@ -297,18 +1579,15 @@ class Prepdev():
         self.pip_install = "{} install --timeout {} {{}}"
         self.pip_install = self.pip_install.format(self.pip, self.pip_timeout)
         self.activate_venv = "source {}/bin/activate;".format(self.venv_path)
-        os.makedirs(self.local_repository, exist_ok=True)
+        self.shims_path = os.path.join(self.local_repository, self.shims)
 
+    @traced
     def check_postgresql_version(self):
         """
         Verifica se a versão do postgresql é válida.
         """
-        cmd = ["bash", "-c"]
-        cmd.append("psql --version")
-        # Se o banco existir o script retorna "1".
-        ret = subprocess.check_output(cmd).decode("utf-8")
-        ret = ret.replace("psql", "").replace("(PostgreSQL)", "")
-        version = ret.replace("\n", "").strip()
+        version = self.probe.get("psql_version", self._psql_paths(),
+                                 psql_version)
         major = version.split(".")[0]
         minor = version.split(".")[1]
         major = int(major) >= self._valid_postgresql_major_versions()
@@ -318,19 +1597,33 @@ class Prepdev():
             msg = msg.format(self.min_postgres_version, version)
             raise InvalidPostgresqlVersionError(msg)
 
+    def _psql_paths(self):
+        """
+        Retorna os arquivos que determinam a versão do psql utilizada.
+        """
+        psql = shutil.which("psql") or "psql"
+        return [psql, os.path.realpath(psql), self.postgres_config_base_path,
+                "/usr/lib/postgresql"]
+
+    def probe_environment(self):
+        """
+        Coleta em paralelo os fatos do ambiente que não dependem entre si.
+        """
+        base = self.postgres_config_base_path
+        self.probe.gather({
+            "postgresql_versions": ([base], lambda: sorted(os.listdir(base))),
+            "psql_version": (self._psql_paths(), psql_version),
+            "groups:" + self.current_user: (
+                ["/etc/group", "/etc/passwd"],
+                lambda: get_additional_groups_name(self.current_user))})
+
+    @traced
     def search_dependencies(self):
         """
         Verifica se as dependências estão disponíveis para instalação.
         """
-        missing_packages = []
         print_info("Verificando disponibilidade de pacotes...")
-        cache = apt.cache.Cache()
-        # cache.update() # Para usar este comando é preciso acesso root.
-        for pkg in self.packages:
-            try:
-                cache[pkg]
-            except KeyError:
-                missing_packages.append(pkg)
+        missing_packages = self._missing_packages()
         if missing_packages:
             packages = ", ".join(missing_packages)
             msg = "ATENÇÃO: O pacote(s) " + Colors.BLUE + "{}" + Colors.WARNING
@@ -342,6 +1635,23 @@ class Prepdev():
             print_warning(msg)
             sys.exit(-1)
 
+    def _missing_packages(self):
+        """
+        Retorna os pacotes que não estão disponíveis para instalação.
+        """
+        if apt is None:
+            raise AptNotFoundError("O módulo apt não foi encontrado.")
+        missing_packages = []
+        cache = apt.cache.Cache()
+        # cache.update() # Para usar este comando é preciso acesso root.
+        for pkg in self.packages:
+            try:
+                cache[pkg]
+            except KeyError:
+                missing_packages.append(pkg)
+        return missing_packages
+
+    @traced
     def create_ssh_keys(self):
         """
         Cria(caso necessário) o par de chaves do sigma e sigmalib.
@@ -385,6 +1695,7 @@ class Prepdev():
         sigmalib_keys = cmd.format(sigmalib_keys)
         call(sigmalib_keys)
 
+    @traced
     def create_ssh_config(self):
         """
         Cria(caso necessário) a configuração do ssh para os repositórios.
@@ -427,42 +1738,48 @@ class Prepdev():
                                               self.sigmalib_ssh_key))
         self.set_ssh_config_permissions()
 
-    def github_sigma_configured(self):
+    def github_sigma_configured(self, timeout=None):
         """
         Verifica se o github foi configurado com a chave do sigma.
         """
-        ssh_sigma = "ssh -T git@sigma.github.com"
-        output = ""
-
-        with subprocess.Popen(ssh_sigma,
-                              shell=True,
-                              bufsize=255,
-                              stdin=subprocess.PIPE,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE,
-                              close_fds=True) as ssh:
-            output = str(ssh.stderr.readlines()[0])
-
-        return "ativasistemas/sigma" in output
+        return self._github_access("sigma.github.com", "ativasistemas/sigma",
+                                   timeout)
 
-
-    def github_sigmalib_configured(self):
+    def github_sigmalib_configured(self, timeout=None):
         """
         Verifica se o github foi configurado com a chave do sigmalib.
         """
-        ssh_sigmalib = "ssh -T git@sigmalib.github.com"
+        return self._github_access("sigmalib.github.com",
+                                   "ativasistemas/sigmalib", timeout)
+
+    def _github_access(self, host, repository, timeout=None):
+        """
+        Verifica se o github reconhece a chave configurada para host.
+
+        Com timeout o ssh não pede interação e desiste após timeout segundos.
+        """
+        ssh_cmd = "ssh -T git@{}".format(host)
+        if timeout is not None:
+            ssh_cmd = "ssh -o ConnectTimeout={} -o BatchMode=yes -T git@{}"
+            ssh_cmd = ssh_cmd.format(int(math.ceil(timeout)), host)
 
-        with subprocess.Popen(ssh_sigmalib,
+        with subprocess.Popen(ssh_cmd,
                               shell=True,
                               bufsize=255,
                               stdin=subprocess.PIPE,
                               stdout=subprocess.PIPE,
                               stderr=subprocess.PIPE,
                               close_fds=True) as ssh:
-            output = str(ssh.stderr.readlines()[0])
+            try:
+                _, stderr = ssh.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                ssh.kill()
+                return False
+        output = str(stderr.splitlines()[:1])
 
-        return "ativasistemas/sigmalib" in output
+        return repository in output
 
+    @traced
     def github_configured(self):
         configured = True
 
@@ -492,30 +1809,103 @@ class Prepdev():
 
         if configured is False:
             msg = "Acesse o github e permita o acesso para a(s) chave(s) acima."
+            if self._bundle("sigma") != "" and self._bundle("sigmalib") != "":
+                # Os repositórios são clonados dos bundles mesmo sem acesso
+                # ao github(ex.: máquina offline); somente a atualização
+                # após o clone fica para depois.
+                print_warning(msg)
+                return
             raise GitHubNotConfiguredError(msg)
 
+    @traced
     def clone_sigmalib(self):
         msg = "Clonando sigmalib..."
         print_info(msg)
-        cmd = "git clone {} {}".format(self.url_sigmalib,
-                                       self.sigmalib_path)
-        call(cmd)
+        self._clone("sigmalib", self.url_sigmalib, self.sigmalib_path)
 
+    @traced
     def clone_sigma(self):
         msg = "Clonando sigma..."
         print_info(msg)
-        cmd = "git clone {} {}".format(self.url_sigma, self.sigma_path)
-        call(cmd)
+        self._clone("sigma", self.url_sigma, self.sigma_path)
+
+    def _bundle(self, name):
+        """
+        Retorna o git bundle do repositório name(vazio quando não existe).
+        """
+        if self.bundle_dir == "":
+            return ""
+        bundle = os.path.join(self.bundle_dir, name + ".bundle")
+        if os.path.exists(bundle) is True:
+            return bundle
+        return ""
+
+    def _clone(self, name, url, path):
+        """
+        Clona o repositório, a partir do git bundle quando ele existir.
 
+        O clone do bundle é local. Em seguida o remote passa a ser o
+        repositório real e, havendo rede, somente os commits posteriores ao
+        bundle são buscados e o branch corrente avança(fast-forward) até
+        eles. O acesso ssh continua necessário para esta atualização e para
+        o install_sigmalib.
+        """
+        bundle = self._bundle(name)
+        if bundle == "":
+            sources = [("git", "git clone --progress {} {}".format(url, path))]
+            git_mirror = self.read_config("git_mirror", "network")
+            mirror = os.path.join(git_mirror, name + ".git")
+            if git_mirror != "" and os.path.exists(mirror) is True:
+                cmd = "git clone --progress {} {} && "
+                cmd += "git -C {} remote set-url origin {}"
+                sources.append(("git_mirror",
+                                cmd.format(mirror, path, path, url)))
+
+            def cleanup():
+                # Remove o clone incompleto antes da próxima tentativa.
+                shutil.rmtree(path, ignore_errors=True)
+
+            self._network_call("git:" + name, sources, cleanup)
+            return
+        print_info("Usando o bundle {}".format(bundle))
+        call("git clone {} {}".format(bundle, path))
+        call("git -C {} remote set-url origin {}".format(path, url))
+        cmd = "timeout {} git -C {} fetch origin".format(self.fetch_timeout,
+                                                          path)
+        if call(cmd) != 0:
+            msg = "Sem acesso a {}. O repositório ficou na versão do bundle."
+            print_error(msg.format(url), bold=True)
+            return
+        if call("git -C {} merge --ff-only @{{u}}".format(path)) != 0:
+            msg = "Não consegui avançar {} até o origin. O repositório ficou "
+            msg += "na versão do bundle."
+            print_error(msg.format(path), bold=True)
+
+    @traced
+    def create_bundles(self):
+        """
+        Gera os git bundles do sigma e sigmalib a partir dos repositórios
+        locais, para provisionar máquinas sem acesso aos repositórios.
+        """
+        os.makedirs(self.bundles_output, exist_ok=True)
+        for name, path in [("sigma", self.sigma_path),
+                           ("sigmalib", self.sigmalib_path)]:
+            bundle = os.path.join(self.bundles_output, name + ".bundle")
+            print_info("Gerando {}...".format(bundle))
+            cmd = ["git", "-C", path, "bundle", "create", bundle, "--all"]
+            subprocess.check_call(cmd, stderr=subprocess.DEVNULL)
+        msg = "Use os bundles com: prepdev --bundle-dir {}"
+        print_info(msg.format(self.bundles_output))
+
+    @traced
     def update_packages(self):
         print_info("Atualizando pip...")
-        cmd = self.pip_install.format("-U pip")
-        call(cmd)
+        self._pip("pip", "-U pip")
 
         print_info("Atualizando setuptools...")
-        cmd = self.pip_install.format("-U setuptools")
-        call(cmd)
+        self._pip("setuptools", "-U setuptools")
 
+    @traced
     def setup_develop(self):
         """
         Prepara o ambiente para rodar o sigma.
@@ -526,15 +1916,14 @@ class Prepdev():
         call(cmd)
 
         # Dependências para testes e ferramentas de auxílio ao desenvolvimento.
-        cmd = "cd {}; {} install -e .[test,dev]".format(self.sigma_path,
-                                                        self.pip)
-        call(cmd)
+        self._pip("sigma_dev", "-e .[test,dev]", self.sigma_path)
 
         # sigmalib
         cmd = "cd {}; {} setup.py develop".format(self.sigmalib_path,
                                                   self.python)
         call(cmd)
 
+    @traced
     def install_sigmalib(self):
         msg = "Instalando sigmalib..."
         print_info(msg)
@@ -542,21 +1931,183 @@ class Prepdev():
         # jscrambler
         url = "git+ssh://git@github.com/gjcarneiro/python-jscrambler.git"
         url += "#egg=jscrambler-2.0b1"
-        cmd = self.pip_install.format(url)
-        call(cmd)
+        self._pip("jscrambler", url, mirror_requirement="jscrambler==2.0b1")
 
         # sigmalib
         url = "git+ssh://git@sigmalib.github.com/ativasistemas/sigmalib.git"
         url += "#egg=sigmalib-0.9.2"
-        cmd = self.pip_install.format(url)
-        call(cmd)
+        self._pip("sigmalib", url, mirror_requirement="sigmalib==0.9.2")
+
+    def _pip(self, operation, requirement, cwd="", mirror_requirement=None):
+        """
+        Instala requirement com o pip do ambiente virtual.
+
+        Quando o índice padrão falha, usa o espelho configurado em network.
+        pip_mirror no .prepdevrc: um diretório de pacotes(--find-links) ou a
+        url de um índice local. As instalações não são encerradas por falta
+        de saída, pois a compilação de pacotes(lxml, psycopg2) é silenciosa.
+        """
+        prefix = "cd {}; ".format(cwd) if cwd != "" else ""
+        sources = [("pip", prefix + self.pip_install.format(requirement))]
+        pip_mirror = self.read_config("pip_mirror", "network")
+        if pip_mirror != "":
+            if os.path.isdir(pip_mirror) is True:
+                options = "--no-index --find-links {}".format(pip_mirror)
+            else:
+                options = "--index-url {}".format(pip_mirror)
+            requirement = mirror_requirement or requirement
+            cmd = prefix + self.pip_install.format(options + " " + requirement)
+            sources.append(("pip_mirror", cmd))
+        return self._network_call("pip:" + operation, sources,
+                                  idle_kill=False)
+
+    def _network_timeout(self, operation):
+        """
+        Retorna o tempo máximo de uma operação de rede.
 
+        Derivado das durações anteriores da operação(network_timeout_factor
+        vezes o p95), limitado entre network_min_timeout e
+        network_max_timeout. Sem histórico usa network_max_timeout.
+        """
+        if self._statistics is None:
+            try:
+                self._statistics = self.step_statistics()
+            except sqlite3.Error:
+                self._statistics = {}
+        statistic = self._statistics.get("network:" + operation)
+        if statistic is None or statistic["runs"] < self.regression_min_runs:
+            return self.network_max_timeout
+        timeout = statistic["p95"] * self.network_timeout_factor
+        return min(max(timeout, self.network_min_timeout),
+                   self.network_max_timeout)
+
+    def _network_call(self, operation, sources, cleanup=None,
+                      idle_kill=True):
+        """
+        Executa uma operação de rede com timeout, novas tentativas e fontes
+        alternativas.
+
+        sources é uma lista de (fonte, comando) em ordem de preferência. Cada
+        fonte é tentada network_attempts vezes, com espera exponencial e
+        aleatória(jitter) entre as tentativas, antes de passar para a
+        próxima. cleanup é chamado após cada tentativa que falhou. Com
+        idle_kill a tentativa é encerrada quando fica network_kill_after
+        segundos sem produzir saída. Comandos com sudo têm a senha validada
+        antes de cada tentativa, assim o tempo do usuário no prompt da senha
+        não conta como tempo sem saída.
+
+        Retorna o código de saída da última tentativa.
+        """
+        timeout = self._network_timeout(operation)
+        kill_after = self.network_kill_after if idle_kill is True else None
+        returncode = 0
+        for position, (source, command) in enumerate(sources):
+            for attempt in range(1, self.network_attempts + 1):
+                start = time.time()
+                record = position == 0 and attempt == 1
+                if self.sudo_command.search(command) is not None:
+                    returncode = subprocess.call(["sudo", "-v"])
+                    if returncode != 0:
+                        return returncode
+                returncode = call(command, timeout=timeout,
+                                  kill_after=kill_after,
+                                  record=record)
+                if returncode == 0:
+                    self.record_trace("network", start, time.time(),
+                                      operation=operation, source=source,
+                                      attempt=attempt)
+                    return 0
+                self.record_trace("network_failure", start, time.time(),
+                                  operation=operation, source=source,
+                                  attempt=attempt, returncode=returncode)
+                if cleanup is not None:
+                    cleanup()
+                if attempt < self.network_attempts:
+                    delay = self.network_backoff * 2 ** (attempt - 1)
+                    delay = random.uniform(0, delay)
+                    msg = "{} falhou({}). Nova tentativa em {:.1f}s..."
+                    print_warning(msg.format(operation, source, delay))
+                    time.sleep(delay)
+            if position + 1 < len(sources):
+                msg = "{} indisponível para {}. Usando {}..."
+                print_warning(msg.format(source, operation,
+                                         sources[position + 1][0]))
+        return returncode
+
+    @traced
     def close_db_connections(self):
         print_info("Derrubando conexões com o banco de dados.")
-        cmd = "psql -h localhost -U postgres -c {}"
-        cmd += cmd.format(self.disconnect_db_command)
-        call(cmd)
+        try:
+            self.drain_database()
+        except subprocess.CalledProcessError:
+            print_warning("Não foi possível conectar ao banco de dados.")
+
+    def drain_database(self, database=None, keep_blocked=False):
+        """
+        Derruba as conexões com o banco e aguarda até que ele fique ocioso.
+
+        Novas conexões são bloqueadas(pg_database.datallowconn) antes das
+        existentes serem derrubadas, assim servidores da aplicação não
+        conseguem reconectar durante a espera. Com keep_blocked=True o banco
+        continua bloqueado(ex.: para ser excluído em seguida), caso contrário
+        as conexões são liberadas ao final.
+
+        Retorna True quando o banco ficou ocioso dentro de drain_timeout.
+        """
+        database = database or self.database_name
+        sql = "SELECT count(*) FROM pg_database WHERE datname = '{}'"
+        if query(sql.format(database)) == "0":
+            return True
+        self._allow_connections(database, False)
+        drained = False
+        try:
+            idle = self._wait_idle(database)
+            drained = True
+        finally:
+            # Em caso de erro(ou Ctrl+C) o banco nunca fica bloqueado.
+            if keep_blocked is False or drained is False:
+                self._allow_connections(database, True)
+        return idle
+
+    def _wait_idle(self, database):
+        """
+        Derruba as conexões com o banco até que ele fique ocioso ou até
+        drain_timeout. Retorna True quando o banco ficou ocioso.
+        """
+        sessions = "SELECT coalesce(nullif(application_name, ''), '?') || "
+        sessions += "' (' || usename || ')', count(*) FROM pg_stat_activity "
+        sessions += "WHERE datname = '{}' AND pid <> pg_backend_pid() "
+        sessions += "GROUP BY 1 ORDER BY 2 DESC"
+        sessions = sessions.format(database)
+        terminate = "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+        terminate += "WHERE datname = '{}' AND pid <> pg_backend_pid()"
+        terminate = terminate.format(database)
+        holders = query(sessions).splitlines()
+        for holder in holders:
+            application, count = holder.rsplit("|", 1)
+            msg = "Derrubando {} conexão(ões) de {}".format(count, application)
+            print_info(msg)
+        limit = time.monotonic() + self.drain_timeout
+        idle = not holders
+        while idle is False and time.monotonic() < limit:
+            query(terminate)
+            time.sleep(0.1)
+            idle = query(sessions) == ""
+        if idle is False:
+            msg = "O banco {} ainda possui conexões após {}s: {}"
+            remaining = ", ".join(line.rsplit("|", 1)[0]
+                                  for line in query(sessions).splitlines())
+            print_warning(msg.format(database, self.drain_timeout, remaining))
+        return idle
+
+    def _allow_connections(self, database, allow):
+        """
+        Libera ou bloqueia novas conexões com o banco de dados.
+        """
+        sql = "UPDATE pg_database SET datallowconn = {} WHERE datname = '{}'"
+        query(sql.format("true" if allow else "false", database))
 
+    @traced
     def prepare_database(self):
         if self._database_exists() is True:
             if self.excludedb is False:
@@ -565,7 +2116,8 @@ class Prepdev():
                 msg += "excluí-lo e criá-lo novamente?(s/" + Colors.BOLD + "[N]"
                 msg += Colors.ENDC + Colors.WARNING + ")"
                 msg = msg.format(self.database_name)
-                answer = input(Colors.WARNING + msg + Colors.ENDC)
+                answer = self.ask("drop_database",
+                                  Colors.WARNING + msg + Colors.ENDC)
             else:
                 answer = "y"
             if answer in self.positive_answer:
@@ -589,28 +2141,241 @@ class Prepdev():
             self._drop_group("gusuarios_do_sigma")
             self._drop_group("gimportacao_sigma")
         self._generate_environment()
-        self._copy_environment()
-        self._restart_database()
+        if self._environment_changed() is True:
+            self._copy_environment()
+            self._restart_database()
+        else:
+            print_info("Arquivo environment inalterado. Reinício desnecessário.")
         self._set_postgres_password()
 
     def _restart_database(self):
+        """
+        Reinicia somente o cluster utilizado pelo sigma.
+
+        Após o reinício aguarda até que o servidor aceite conexões.
+        """
         print_info("Reiniciando banco de dados...")
-        cmd = "sudo service postgresql restart"
+        version, cluster = self._cluster_version_and_name()
+        cmd = "sudo pg_ctlcluster {} {} restart".format(version, cluster)
         call(cmd)
+        self._wait_database()
+
+    def _wait_database(self):
+        """
+        Aguarda até que o servidor de banco de dados aceite conexões.
+        """
+        print_info("Aguardando o banco de dados aceitar conexões...")
+        host = self.config["sigma:database"]["host"]
+        port = self.config["sigma:database"]["port"]
+        cmd = ["pg_isready", "-q", "-h", host, "-p", port, "-U", "postgres"]
+        limit = time.monotonic() + self.postgres_ready_timeout
+        while time.monotonic() < limit:
+            if subprocess.call(cmd) == 0:
+                return
+            time.sleep(0.2)
+        msg = "O banco de dados não aceitou conexões em {} segundos."
+        msg = msg.format(self.postgres_ready_timeout)
+        raise DatabaseNotReadyError(msg)
+
+    def _cluster_version_and_name(self):
+        """
+        Retorna a versão e o nome do cluster detectado.
+        """
+        if self.postgres_cluster == "":
+            self.set_postgresql_cluster()
+        version, cluster = self.postgres_cluster.split(os.sep)[-2:]
+        return version, cluster
+
+    def _tuning_file(self):
+        """
+        Retorna o arquivo do perfil de tuning no conf.d do cluster.
+        """
+        if self.postgres_cluster == "":
+            self.set_postgresql_cluster()
+        return os.path.join(self.postgres_cluster, "conf.d",
+                            self.tuning_file_name)
+
+    def _tuning_settings(self):
+        """
+        Retorna as configurações do perfil de desenvolvimento.
+
+        Os valores são calculados a partir da memória e dos núcleos da
+        máquina e todas as configurações são aplicadas sem reiniciar o
+        servidor(reload).
+        """
+        memory_mb = (memory_kb() or 2097152) // 1024
+        cpus = os.cpu_count() or 1
+        version = self._cluster_version_and_name()[0]
+        major, minor = (int(part) for part in (version.split(".") + ["0"])[:2])
+        version = major * 100 + (minor if major < 10 else 0)
+        settings = [
+            ("maintenance_work_mem",
+             "{}MB".format(max(64, min(memory_mb // 16, 2048)))),
+            ("work_mem", "{}MB".format(max(4, min(memory_mb // (cpus * 16),
+                                                  64)))),
+            ("effective_cache_size", "{}MB".format(memory_mb * 3 // 4)),
+            ("checkpoint_timeout", "30min"),
+            ("checkpoint_completion_target", "0.9"),
+            # Somente em desenvolvimento: uma queda do servidor pode perder
+            # as últimas transações, mas nunca corrompe o banco.
+            ("synchronous_commit", "off")]
+        if version >= 905:
+            settings.append(("max_wal_size", "4GB"))
+        else:
+            settings.append(("checkpoint_segments", "64"))
+        if version >= 1100:
+            settings.append(("max_parallel_maintenance_workers",
+                             str(max(1, cpus // 2))))
+        return settings
+
+    def _conf_d_enabled(self):
+        """
+        Verifica se o postgresql.conf do cluster inclui o diretório conf.d.
+        """
+        postgresql_conf = os.path.join(self.postgres_cluster,
+                                       "postgresql.conf")
+        with open(postgresql_conf, "r") as conf:
+            for line in conf.readlines():
+                line = line.strip()
+                if line.startswith("include_dir") and "conf.d" in line:
+                    return True
+        return False
+
+    @traced
+    def tune_postgresql(self):
+        """
+        Aplica o perfil de tuning para desenvolvimento no cluster.
+
+        O perfil é um arquivo próprio no conf.d do cluster, portanto é
+        desfeito com --untune-postgresql sem tocar no postgresql.conf.
+        """
+        tuning_file = self._tuning_file()
+        if self._conf_d_enabled() is False:
+            msg = "O postgresql.conf de {} não inclui o diretório conf.d "
+            msg += "(include_dir = 'conf.d'). Habilite-o e execute novamente."
+            print_error(msg.format(self.postgres_cluster))
+            return 1
+        lines = ["# Perfil de desenvolvimento criado pelo prepdev.",
+                 "# Remova com: prepdev --untune-postgresql"]
+        for name, value in self._tuning_settings():
+            lines.append("{} = '{}'".format(name, value))
+            print_blue("{} = {}".format(name, value))
+        temporary = NamedTemporaryFile("w", suffix=".conf", delete=False)
+        with temporary:
+            temporary.write("\n".join(lines) + "\n")
+        os.chmod(temporary.name, 0o644)
+        print_info("Aplicando perfil de tuning em {}...".format(tuning_file))
+        returncode = call("sudo cp -f {} {}".format(temporary.name,
+                                                    tuning_file))
+        os.remove(temporary.name)
+        if returncode != 0:
+            msg = "Não foi possível copiar o perfil de tuning para {}."
+            print_error(msg.format(tuning_file))
+            return 1
+        self._reload_database()
+        problems = self._tuning_problems(tuning_file)
+        if problems:
+            print_error("O perfil de tuning não foi aplicado:", bold=True)
+            for problem in problems:
+                print_warning("    " + problem)
+            return 1
+        msg = "Execute prepdev --resetdb e prepdev --stats para comparar a "
+        msg += "carga do banco antes e depois do tuning."
+        print_info(msg)
+
+    @traced
+    def untune_postgresql(self):
+        """
+        Remove o perfil de tuning e restaura as configurações do cluster.
+        """
+        tuning_file = self._tuning_file()
+        if os.path.exists(tuning_file) is False:
+            print_info("O perfil de tuning não está aplicado.")
+            return
+        print_info("Removendo perfil de tuning...")
+        if call("sudo rm -f {}".format(tuning_file)) != 0:
+            msg = "Não foi possível remover o perfil de tuning {}."
+            print_error(msg.format(tuning_file))
+            return 1
+        self._reload_database()
+
+    def _tuning_problems(self, tuning_file):
+        """
+        Retorna as configurações do perfil que o servidor não aplicou.
+
+        Usa o pg_file_settings(9.5+), que aponta erros de sintaxe/valor e
+        configurações sobrescritas(ex.: ALTER SYSTEM). Nas versões
+        anteriores verifica se o valor em uso veio do arquivo do perfil,
+        aguardando até reload_timeout segundos pelo reload.
+        """
+        sql = "SELECT name || ': ' || coalesce(error, 'não aplicada') "
+        sql += "FROM pg_file_settings WHERE sourcefile = '{}' "
+        sql += "AND (error IS NOT NULL OR NOT applied) ORDER BY name"
+        try:
+            return query(sql.format(tuning_file), quiet=True).splitlines()
+        except subprocess.CalledProcessError:
+            pass
+        names = ", ".join("'{}'".format(name)
+                          for name, _ in self._tuning_settings())
+        sql = "SELECT name || ': ' || current_setting(name) FROM pg_settings "
+        sql += "WHERE name IN ({}) AND sourcefile IS DISTINCT FROM '{}' "
+        sql += "ORDER BY name"
+        # O pg_reload_conf só sinaliza o servidor: as novas conexões recebem
+        # as configurações após ele processar o sinal.
+        limit = time.monotonic() + self.reload_timeout
+        while True:
+            problems = query(sql.format(names, tuning_file)).splitlines()
+            if not problems or time.monotonic() >= limit:
+                return problems
+            time.sleep(0.2)
+
+    def _reload_database(self):
+        """
+        Recarrega as configurações do servidor sem derrubar as conexões.
+        """
+        query("SELECT pg_reload_conf()")
+        sql = "SELECT name FROM pg_settings WHERE pending_restart"
+        try:
+            pending = query(sql, quiet=True).split()
+        except subprocess.CalledProcessError:
+            # pending_restart não existe antes do 9.5.
+            pending = []
+        if pending:
+            msg = "As configurações {} só terão efeito após reiniciar o "
+            msg += "servidor."
+            print_warning(msg.format(", ".join(pending)))
+
+    def _environment_changed(self):
+        """
+        Verifica se o environment gerado difere do instalado no cluster.
+        """
+        if self.postgres_cluster == "":
+            self.set_postgresql_cluster()
+        installed = os.path.join(self.postgres_cluster, "environment")
+        try:
+            return file_hash(self.postgres_environment) != file_hash(installed)
+        except OSError:
+            return True
+
+    def _database_exists(self):
+        cmd = ["bash", "-c"]
+        cmd_psql = "psql -h localhost -U postgres -lqt | cut -d \| -f 1 | "
+        cmd_psql += "grep -w {} | wc -l"
+        cmd_psql = cmd_psql.format(self.database_name)
+        cmd.append(cmd_psql)
+        # Se o banco existir o script retorna "1".
+        return "1" in str(subprocess.check_output(cmd))
 
-    def _database_exists(self):
-        cmd = ["bash", "-c"]
-        cmd_psql = "psql -h localhost -U postgres -lqt | cut -d \| -f 1 | "
-        cmd_psql += "grep -w {} | wc -l"
-        cmd_psql = cmd_psql.format(self.database_name)
-        cmd.append(cmd_psql)
-        # Se o banco existir o script retorna "1".
-        return "1" in str(subprocess.check_output(cmd))
-
     def _drop_database(self):
         print_info("Excluindo banco de dados...")
+        self.drain_database(keep_blocked=True)
         cmd = "dropdb -h localhost -U postgres {}".format(self.database_name)
-        call(cmd)
+        dropped = False
+        try:
+            dropped = call(cmd) == 0
+        finally:
+            if dropped is False:
+                self._allow_connections(self.database_name, True)
 
     def _drop_user(self, username):
         username = username.strip()
@@ -637,7 +2402,10 @@ class Prepdev():
 
     def _copy_environment(self):
         print_info("Copiando environment para o servidor de banco de dados...")
-        cmd = "sudo cp -f /tmp/environment /etc/postgresql/9.4/main/"
+        if self.postgres_cluster == "":
+            self.set_postgresql_cluster()
+        cmd = "sudo cp -f {} {}/".format(self.postgres_environment,
+                                         self.postgres_cluster)
         call(cmd)
 
     def _set_postgres_password(self):
@@ -646,35 +2414,1040 @@ class Prepdev():
         cmd += "encrypted password '123Abcde'\""
         call(cmd)
 
+    @traced
     def run_migrations(self):
         print_info("Executando migrações...")
-        if self._database_exists() is False:
-            # cmd = self.activate_venv
-            cmd = "cd {}; {} sigma/migrations/sprint_1.py {};"
-            cmd = cmd.format(self.sigma_path, self.python, self.ini_file)
-            call(cmd, True)
+        profiler = MigrationProfiler(self.database_name)
+        statements = StatementProfiler(self.database_name)
+        statements.reset()
+        profiler.start()
+        try:
+            if self._database_exists() is False:
+                # cmd = self.activate_venv
+                cmd = "cd {}; {} sigma/migrations/sprint_1.py {};"
+                cmd = cmd.format(self.sigma_path, self.python, self.ini_file)
+                call(cmd, True)
+                profiler.mark("sprint_1")
+            self._run_pending_migrations(profiler.feed)
+        finally:
+            profiler.stop()
+        hotspots = statements.hotspots()
+        for migration in profiler.migrations:
+            self.record_trace("migration", migration["start"],
+                              migration["end"], migration=migration["name"],
+                              statement=migration["statement"])
+        if hotspots:
+            now = time.time()
+            self.record_trace("migration_statements", now, now,
+                              statements=hotspots)
+        self.print_migrations_report(profiler.migrations, hotspots)
+
+    def _run_pending_migrations(self, on_line=None):
+        """
+        Executa somente as migrações ainda não aplicadas.
+
+        on_line recebe cada linha da saída do executor de migrações.
+        """
         cmd = self.activate_venv
         cmd += "cd {}; sigma_run_migrations -b {}".format(self.sigma_path,
                                                           self.ini_file)
-        call(cmd, True)
+        call(cmd, True, on_line=on_line)
 
+    def print_migrations_report(self, migrations, hotspots):
+        """
+        Imprime as migrações e os comandos sql mais demorados.
+        """
+        if not migrations:
+            return
+        print_info("Migrações mais demoradas:", bold=True)
+        ranking = sorted(migrations, key=lambda m: m["duration"], reverse=True)
+        for migration in ranking[:10]:
+            msg = "{:>9.2f}s  {}".format(migration["duration"],
+                                         migration["name"])
+            print_blue(msg)
+        if hotspots:
+            print_info("Comandos sql mais demorados:", bold=True)
+            for hotspot in hotspots:
+                msg = "{:>9.2f}s  {:>6}x  {}".format(hotspot["seconds"],
+                                                     hotspot["calls"],
+                                                     hotspot["query"][:60])
+                print_blue(msg)
+
+    @traced
     def populate_db(self):
         msg = "Deseja carregar os dados de desenvolvimento no banco de dados? "
         msg += "([" + Colors.BOLD + "S]" + Colors.ENDC + Colors.WARNING + "/n)"
         msg += Colors.ENDC
-        answer = input(Colors.WARNING + msg + Colors.ENDC)
+        answer = self.ask("populate_db", Colors.WARNING + msg + Colors.ENDC)
         if answer == "":
             answer = "s"
         if answer in self.positive_answer:
-            sqls = os.path.join(self.sigma_path, "sigma", "sql", "dev")
-            for files in reversed(list(os.walk(sqls, topdown=False))):
-                for sql in files[-1]:
-                    if ".sql" in sql[-4:]:
-                        sql_file = files[0] + "/" + sql
-                        sql_file = self._pre_process_sql(sql_file)
-                        cmd = "psql -h localhost -U postgres -d {} -f {}"
-                        cmd = cmd.format(self.database_name, sql_file)
-                        call(cmd, True)
+            deferred = False
+            if self.defer_constraints is True:
+                deferred = self.drop_deferrable_objects()
+            try:
+                self._load_seeds()
+            finally:
+                if deferred is True:
+                    self.restore_deferrable_objects()
+
+    def _jobs(self):
+        """
+        Retorna o número de conexões das tarefas paralelas no banco.
+        """
+        if self.seed_jobs > 1:
+            return self.seed_jobs
+        return min(self.max_seed_jobs, os.cpu_count() or 1)
+
+    def _load_seeds(self):
+        seed_files = self._seed_files()
+        # A carga paralela é opcional(--seed-jobs).
+        if self.seed_jobs > 1 and len(seed_files) > 1:
+            self._load_seed_files(seed_files, self.seed_jobs)
+        else:
+            for sql_file in seed_files:
+                self._load_sql(sql_file)
+
+    def _deferrable_objects(self):
+        """
+        Retorna os índices secundários e as chaves estrangeiras dos schemas
+        do sigma.
+
+        Os índices únicos(constraints ou CREATE UNIQUE INDEX) e de exclusion
+        constraints são mantidos, pois alteram o resultado da carga(ON
+        CONFLICT, chaves duplicadas). Retorna {"indexes": [[índice, tabela,
+        definição]], "foreign_keys": [[tabela, constraint, definição]]}.
+        """
+        schemas = ", ".join("'{}'".format(schema) for schema
+                            in INTERPOLATION_VALUES["schemas"].values())
+        sql = "SELECT i.indexrelid::regclass::text, "
+        sql += "i.indrelid::regclass::text, pg_get_indexdef(i.indexrelid) "
+        sql += "FROM pg_index i "
+        sql += "JOIN pg_class c ON c.oid = i.indrelid "
+        sql += "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        sql += "WHERE n.nspname IN ({}) AND NOT i.indisunique "
+        sql += "AND NOT EXISTS (SELECT 1 "
+        sql += "FROM pg_constraint k WHERE k.conindid = i.indexrelid "
+        sql += "AND k.conrelid = i.indrelid AND k.contype IN ('p', 'u', 'x')) "
+        sql += "ORDER BY 1"
+        output = query(sql.format(schemas), self.database_name)
+        indexes = [line.split("|", 2) for line in output.splitlines()]
+        sql = "SELECT k.conrelid::regclass::text, quote_ident(k.conname), "
+        sql += "pg_get_constraintdef(k.oid) FROM pg_constraint k "
+        sql += "JOIN pg_namespace n ON n.oid = k.connamespace "
+        sql += "WHERE k.contype = 'f' AND n.nspname IN ({}) ORDER BY 1, 2"
+        output = query(sql.format(schemas), self.database_name)
+        foreign_keys = [line.split("|", 2) for line in output.splitlines()]
+        return {"indexes": indexes, "foreign_keys": foreign_keys}
+
+    def _deferred_file(self):
+        return os.path.join(self.cache_dir, "deferred_objects.json")
+
+    def drop_deferrable_objects(self):
+        """
+        Remove os índices secundários e as chaves estrangeiras antes da carga.
+
+        As definições são gravadas no cache antes da remoção, assim uma
+        carga interrompida é desfeita por restore_deferrable_objects, mesmo
+        em uma próxima execução.
+
+        Retorna False(sem remover nada) quando objetos de uma carga anterior
+        não puderam ser restaurados.
+        """
+        if os.path.exists(self._deferred_file()) is True:
+            # Sobra de uma carga interrompida.
+            if self.restore_deferrable_objects() is False:
+                print_warning("A carga será feita sem adiar os índices.")
+                return False
+        objects = self._deferrable_objects()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        write_atomic(self._deferred_file(), json.dumps(objects, indent=2))
+        sql = "BEGIN;\n"
+        for table, name, _ in objects["foreign_keys"]:
+            sql += "ALTER TABLE {} DROP CONSTRAINT {};\n".format(table, name)
+        for index, _, _ in objects["indexes"]:
+            sql += "DROP INDEX {};\n".format(index)
+        sql += "COMMIT;\n"
+        query(sql, self.database_name)
+        msg = "{} índices e {} chaves estrangeiras adiados para após a carga."
+        print_info(msg.format(len(objects["indexes"]),
+                              len(objects["foreign_keys"])))
+        return True
+
+    def restore_deferrable_objects(self):
+        """
+        Recria os índices e as chaves estrangeiras removidos antes da carga.
+
+        Os índices são criados em paralelo. As chaves estrangeiras são
+        criadas como NOT VALID e validadas em seguida, em paralelo por
+        tabela. Cada objeto é restaurado independentemente: os que falharem
+        são informados e permanecem no cache para a próxima execução.
+        Objetos que já existem não são recriados.
+
+        Retorna True quando todos os objetos foram restaurados.
+        """
+        with open(self._deferred_file(), "r") as file_:
+            objects = json.load(file_)
+        current = self._deferrable_objects()
+        existing = set(index for index, _, _ in current["indexes"])
+        indexes = [index for index in objects["indexes"]
+                   if index[0] not in existing]
+        existing = dict(((table, name), definition) for table, name, definition
+                        in current["foreign_keys"])
+        start = time.time()
+
+        def create_index(index):
+            try:
+                query(index[2], self.database_name)
+            except subprocess.CalledProcessError:
+                return False
+            return True
+
+        failed = {"indexes": [], "foreign_keys": []}
+        with ThreadPoolExecutor(max_workers=self._jobs()) as executor:
+            for index, created in zip(indexes,
+                                      executor.map(create_index, indexes)):
+                if created is False:
+                    failed["indexes"].append(index)
+        indexes_time = time.time() - start
+        validate = {}
+        for foreign_key in objects["foreign_keys"]:
+            table, name, definition = foreign_key
+            valid = definition.endswith("NOT VALID") is False
+            if (table, name) not in existing:
+                sql = "ALTER TABLE {} ADD CONSTRAINT {} {}".format(
+                    table, name, definition + (" NOT VALID" if valid else ""))
+                try:
+                    query(sql, self.database_name)
+                except subprocess.CalledProcessError:
+                    failed["foreign_keys"].append(foreign_key)
+                    continue
+            elif existing[(table, name)].endswith("NOT VALID") is False:
+                continue
+            if valid is True:
+                validate.setdefault(table, []).append(foreign_key)
+
+        def validate_table(table):
+            not_validated = []
+            for foreign_key in validate[table]:
+                sql = "ALTER TABLE {} VALIDATE CONSTRAINT {}"
+                sql = sql.format(table, foreign_key[1])
+                try:
+                    query(sql, self.database_name)
+                except subprocess.CalledProcessError:
+                    not_validated.append(foreign_key)
+            return not_validated
+
+        with ThreadPoolExecutor(max_workers=self._jobs()) as executor:
+            for not_validated in executor.map(validate_table, validate):
+                failed["foreign_keys"] += not_validated
+        msg = "{} índices recriados em {} e {} chaves estrangeiras em {}."
+        print_info(msg.format(len(indexes), format_duration(indexes_time),
+                              len(objects["foreign_keys"]),
+                              format_duration(time.time() - start -
+                                              indexes_time)))
+        if not failed["indexes"] and not failed["foreign_keys"]:
+            os.remove(self._deferred_file())
+            return True
+        for index, table, _ in failed["indexes"]:
+            print_error("O índice {} de {} não foi recriado.".format(index,
+                                                                     table))
+        for table, name, _ in failed["foreign_keys"]:
+            msg = "A chave estrangeira {} de {} não foi restaurada(ou "
+            msg += "permanece NOT VALID)."
+            print_error(msg.format(name, table))
+        msg = "As definições pendentes foram mantidas em {} e serão "
+        msg += "reaplicadas na próxima carga com --defer-constraints."
+        print_warning(msg.format(self._deferred_file()))
+        write_atomic(self._deferred_file(), json.dumps(failed, indent=2))
+        return False
+
+    def _seed_targets(self, sql):
+        """
+        Retorna as tabelas alteradas pelo sql.
+
+        Só são reconhecidos INSERT ... VALUES, COPY ... FROM stdin, UPDATE e
+        DELETE simples. Retorna None quando algum comando lê outras tabelas
+        (SELECT, WITH, FROM, USING, ...), não pode ser interpretado ou é de
+        outro tipo(DDL, funções, meta-comandos do psql).
+        """
+        # Remove os dados dos COPY, as strings e os comentários.
+        sql = self.seed_copy_data.sub(r"\1", sql)
+        if "$" in sql:
+            return None
+        sql = re.sub(r"'(?:[^']|'')*'", "''", sql)
+        sql = re.sub(r"--[^\n]*", "", sql)
+        targets = set()
+        for statement in sql.split(";"):
+            statement = statement.strip()
+            if statement == "" or self.seed_control.match(statement):
+                continue
+            match = self.seed_statement.match(statement)
+            if match is None:
+                return None
+            rest = statement[match.end():]
+            if match.group(1).upper() == "COPY":
+                rest = self.seed_copy_from.sub("", rest, count=1)
+            if self.seed_reads.search(rest) is not None:
+                return None
+            targets.add(match.group(2).replace('"', "").lower())
+        return targets
+
+    def _seed_manifest(self):
+        """
+        Lê as dependências declaradas em sql/dev/manifest.ini.
+
+        Retorna {arquivo: [arquivos que devem ser carregados antes]}, com os
+        paths relativos ao diretório sql/dev.
+        """
+        manifest = configparser.RawConfigParser()
+        manifest.optionxform = str
+        manifest.read(os.path.join(self._seeds_path(), self.seed_manifest))
+        if "dependencies" not in manifest:
+            return {}
+        return {name: [dependency.strip() for dependency in value.split(",")
+                       if dependency.strip()]
+                for name, value in manifest["dependencies"].items()}
+
+    def _seed_graph(self, seed_files):
+        """
+        Retorna {arquivo: arquivos que precisam ser carregados antes dele}.
+
+        Dois arquivos mantêm a ordem da carga sequencial quando alteram a
+        mesma tabela ou tabelas ligadas por chave estrangeira. Arquivos com
+        comandos desconhecidos são carregados sozinhos, na mesma posição da
+        carga sequencial. As dependências do manifest.ini têm precedência.
+        """
+        by_name = {}
+        related = {}
+        for table in self._schema_tables():
+            by_name.setdefault(table.split(".")[-1], set()).add(table)
+            related[table] = {table}
+        for table, _, parent, _ in self._foreign_keys():
+            related.setdefault(table, {table}).add(parent)
+            related.setdefault(parent, {parent}).add(table)
+        manifest = self._seed_manifest()
+        seeds_path = self._seeds_path()
+        touched = {}
+        graph = {}
+        for index, filename in enumerate(seed_files):
+            with open(filename, "r") as sql_file:
+                sql = sql_file.read().format(**self.variables)
+            targets = self._seed_targets(sql)
+            if targets is not None:
+                tables = set()
+                for name in targets:
+                    if "." in name:
+                        tables.add(name)
+                    else:
+                        tables |= by_name.get(name, {name})
+                targets = tables
+            touched[filename] = targets
+            relative = os.path.relpath(filename, seeds_path)
+            previous = seed_files[:index]
+            if relative in manifest:
+                graph[filename] = set(os.path.join(seeds_path, dependency)
+                                      for dependency in manifest[relative])
+            elif targets is None:
+                graph[filename] = set(previous)
+            else:
+                footprint = set()
+                for table in targets:
+                    footprint |= related.get(table, {table})
+                graph[filename] = set(earlier for earlier in previous
+                                      if touched[earlier] is None or
+                                      touched[earlier] & footprint)
+        return graph
+
+    def _run_seed_file(self, filename):
+        """
+        Carrega um arquivo sql em uma conexão própria e retorna a saída.
+        """
+        sql_file = self._pre_process_sql(filename)
+        cmd = "psql -h localhost -U postgres -d {} -f {}"
+        cmd = cmd.format(self.database_name, sql_file)
+        start = time.time()
+        with subprocess.Popen(["bash", "-c", cmd], stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT) as process:
+            with PROCESS_LOCK:
+                PROCESS_STACK.append(process.pid)
+            try:
+                output = process.communicate()[0]
+            finally:
+                with PROCESS_LOCK:
+                    PROCESS_STACK.remove(process.pid)
+        return cmd, output, time.time() - start
+
+    def _load_seed_files(self, seed_files, jobs):
+        """
+        Carrega os arquivos sql em paralelo, em até jobs conexões.
+
+        Um arquivo só começa quando os arquivos dos quais depende(veja
+        _seed_graph) terminaram. A saída de cada arquivo é exibida na ordem
+        da carga sequencial.
+        """
+        graph = self._seed_graph(seed_files)
+        step = STEP_STACK[-1] if STEP_STACK else ""
+        pending = list(seed_files)
+        running = {}
+        finished = {}
+        shown = 0
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            while pending or running:
+                ready = [filename for filename in pending
+                         if graph[filename] <= set(finished)]
+                if not ready and not running:
+                    # Dependência circular no manifest.ini.
+                    ready = pending[:1]
+                for filename in ready:
+                    pending.remove(filename)
+                    future = executor.submit(self._run_seed_file, filename)
+                    running[future] = filename
+                done, _ = wait_futures(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    filename = running.pop(future)
+                    cmd, output, seconds = future.result()
+                    COMMAND_LOG.append({"step": step, "command": cmd})
+                    OUTPUT_CAPTURE.record(step, cmd, output, seconds)
+                    finished[filename] = output
+                while (shown < len(seed_files) and
+                       seed_files[shown] in finished):
+                    sys.stdout.buffer.write(finished[seed_files[shown]])
+                    sys.stdout.flush()
+                    shown += 1
+
+    def _seeds_path(self):
+        return os.path.join(self.sigma_path, "sigma", "sql", "dev")
+
+    def _seed_files(self):
+        """
+        Retorna, na ordem de carga, os arquivos sql de desenvolvimento.
+        """
+        seed_files = []
+        sqls = self._seeds_path()
+        for files in reversed(list(os.walk(sqls, topdown=False))):
+            for sql in files[-1]:
+                if ".sql" in sql[-4:]:
+                    seed_files.append(files[0] + "/" + sql)
+        return seed_files
+
+    def _load_sql(self, filename, database=None):
+        """
+        Pré-processa e carrega um arquivo sql no banco de dados.
+        """
+        sql_file = self._pre_process_sql(filename)
+        cmd = "psql -h localhost -U postgres -d {} -f {}"
+        cmd = cmd.format(database or self.database_name, sql_file)
+        call(cmd, True)
+
+    def _reload_seed_files(self, filenames):
+        """
+        Recarrega arquivos sql de desenvolvimento alterados.
+
+        Os arquivos não são reexecutados sobre os dados atuais(um INSERT
+        contra chaves serial duplicaria as linhas): os dados de cada schema
+        afetado são restaurados uma única vez, o que recarrega todos os
+        arquivos do schema. Arquivos que não pertencem a nenhum schema não
+        podem ser recarregados com segurança e são apenas reportados.
+        """
+        reloaded = set()
+        for schema in INTERPOLATION_VALUES["schemas"]:
+            seed_files = self._schema_seed_files(schema)
+            if any(filename in seed_files for filename in filenames):
+                self.reset_database_schema(schema)
+                reloaded.update(seed_files)
+        for filename in filenames:
+            if filename in reloaded:
+                print_info("{} recarregado.".format(filename))
+                continue
+            msg = "Não foi possível recarregar {}(não pertence a nenhum "
+            msg += "schema). Use --resetdb."
+            print_error(msg.format(filename))
+
+    @traced
+    def watch(self):
+        """
+        Reaplica migrações e dados de desenvolvimento quando eles mudam.
+
+        Observa sigma/migrations e sigma/sql/dev. Uma rajada de alterações é
+        agrupada(watch_debounce segundos sem novas alterações) antes de
+        agir: migrações novas/alteradas executam somente o
+        sigma_run_migrations e os dados dos schemas dos arquivos sql
+        alterados são restaurados.
+        """
+        migrations = os.path.join(self.sigma_path, "sigma", "migrations")
+        seeds = os.path.join(self.sigma_path, "sigma", "sql", "dev")
+        watcher = DirectoryWatcher([migrations, seeds])
+        msg = "Observando {} e {}(Ctrl+C para sair)..."
+        print_info(msg.format(migrations, seeds))
+        try:
+            while True:
+                changed = watcher.changes(self.watch_debounce)
+                changed_migrations = [path for path in changed
+                                      if path.startswith(migrations + os.sep)
+                                      and path.endswith(".py")]
+                changed_seeds = [path for path in self._seed_files()
+                                 if path in changed]
+                if changed_migrations:
+                    print_info("Migrações alteradas. Executando migrações...")
+                    self._run_pending_migrations()
+                if changed_seeds:
+                    self._reload_seed_files(changed_seeds)
+        except KeyboardInterrupt:
+            print_info("Observação encerrada.")
+        finally:
+            watcher.close()
+
+    def _schema_seed_files(self, schema):
+        """
+        Retorna os arquivos sql de desenvolvimento que carregam dados em schema.
+
+        Um arquivo pertence ao schema quando está em um diretório com o nome
+        do schema ou quando utiliza a variável {schema_<nome>}.
+        """
+        variable = "{schema_" + schema + "}"
+        seed_files = []
+        for sql_file in self._seed_files():
+            with open(sql_file, "r") as file_:
+                content = file_.read()
+            parts = os.path.dirname(sql_file).split(os.sep)
+            if schema in parts or variable in content:
+                seed_files.append(sql_file)
+        return seed_files
+
+    def _schema_snapshot(self, schema):
+        """
+        Retorna o caminho do snapshot dos dados do schema.
+
+        O nome do arquivo contém o hash dos arquivos sql do schema e da versão
+        das migrações, assim qualquer alteração nos dados de desenvolvimento
+        ou no schema invalida o snapshot.
+        """
+        digest = hashlib.sha256()
+        version = migration_version(self.database_name) or ""
+        digest.update("migrations:{}".format(version).encode("utf-8"))
+        for sql_file in self._schema_seed_files(schema):
+            digest.update(sql_file.encode("utf-8"))
+            digest.update(file_hash(sql_file).encode("utf-8"))
+        name = "{}_{}.dump".format(schema, digest.hexdigest()[:16])
+        return os.path.join(self.cache_dir, name)
+
+    @traced
+    def reset_database_schema(self, schema=None):
+        """
+        Restaura somente os dados de um schema(por padrão o de --reset-schema).
+
+        As tabelas do schema são truncadas e os dados são restaurados do
+        snapshot(quando existir) ou recarregados dos arquivos sql do schema.
+        Usuários, grupos, os demais schemas e o servidor não são alterados.
+        """
+        schema = INTERPOLATION_VALUES["schemas"][schema or self.reset_schema]
+        msg = "Restaurando dados do schema " + Colors.BOLD + "{}" + Colors.ENDC
+        print_info(msg.format(schema))
+        sql = "SELECT quote_ident(schemaname) || '.' || quote_ident(tablename) "
+        sql += "FROM pg_tables WHERE schemaname = '{}'"
+        tables = query(sql.format(schema), self.database_name).split()
+        referencing = self._referencing_tables(schema) if tables else []
+        # O hash usa a versão das migrações, lida antes de truncar as tabelas.
+        snapshot = self._schema_snapshot(schema)
+        backup = ""
+        if referencing:
+            # Os dados das tabelas de outros schemas que referenciam este
+            # são preservados e recarregados após a restauração.
+            msg = "Preservando os dados de {}(referenciam {})..."
+            print_info(msg.format(", ".join(referencing), schema))
+            backup = os.path.join(self.cache_dir, schema + "_referencing.tmp")
+            os.makedirs(self.cache_dir, exist_ok=True)
+            cmd = "pg_dump -h localhost -U postgres -Fc --data-only {} "
+            cmd += "-f {} {}"
+            selected = " ".join("-t '{}'".format(table)
+                                for table in referencing)
+            if call(cmd.format(selected, backup, self.database_name)) != 0:
+                msg = "Não foi possível preservar os dados de {}."
+                print_error(msg.format(", ".join(referencing)))
+                return
+        try:
+            if tables:
+                # Truncar todas as tabelas no mesmo comando deixa o
+                # postgresql resolver a ordem das dependências entre elas.
+                sql = "TRUNCATE {} RESTART IDENTITY;"
+                query(sql.format(", ".join(tables + referencing)),
+                      self.database_name)
+            if os.path.exists(snapshot) is True:
+                print_info("Restaurando snapshot {}...".format(snapshot))
+                self._restore_data(snapshot)
+            else:
+                for sql_file in self._schema_seed_files(schema):
+                    self._load_schema_sql(sql_file, schema)
+                self._save_schema_snapshot(schema, snapshot)
+        finally:
+            if backup != "":
+                try:
+                    self._restore_data(backup)
+                except subprocess.CalledProcessError:
+                    msg = "Não foi possível recarregar os dados de {}. O "
+                    msg += "backup foi mantido em {}."
+                    print_error(msg.format(", ".join(referencing), backup),
+                                bold=True)
+                    raise
+                os.remove(backup)
+        if referencing:
+            # Os dados foram recarregados sem os triggers, portanto as chaves
+            # estrangeiras dessas tabelas são conferidas novamente.
+            invalid = self._check_foreign_keys(referencing)
+            if invalid:
+                msg = "Chaves estrangeiras violadas após a restauração: {}"
+                print_error(msg.format(", ".join(invalid)), bold=True)
+
+    def _restore_data(self, dump):
+        """
+        Carrega os dados de um dump(pg_dump -Fc) sem disparar os triggers.
+        """
+        cmd = "pg_restore -h localhost -U postgres -d {} --data-only "
+        cmd += "--disable-triggers {}"
+        cmd = cmd.format(self.database_name, dump)
+        returncode = call(cmd)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+    def _check_foreign_keys(self, tables):
+        """
+        Confere as chaves estrangeiras das tabelas informadas.
+
+        Cada chave é recriada(e portanto validada) em sua própria
+        transação; uma chave violada é mantida como estava. Retorna as chaves
+        violadas.
+        """
+        names = ", ".join("'{}'::regclass".format(table) for table in tables)
+        sql = "SELECT conrelid::regclass || '|' || quote_ident(conname) || "
+        sql += "'|' || pg_get_constraintdef(oid) FROM pg_constraint "
+        sql += "WHERE contype = 'f' AND convalidated AND conrelid IN ({}) "
+        sql += "ORDER BY 1"
+        invalid = []
+        for line in query(sql.format(names), self.database_name).splitlines():
+            table, name, definition = line.split("|", 2)
+            sql = "BEGIN;\nALTER TABLE {0} DROP CONSTRAINT {1};\n"
+            sql += "ALTER TABLE {0} ADD CONSTRAINT {1} {2};\nCOMMIT;"
+            try:
+                query(sql.format(table, name, definition), self.database_name,
+                      quiet=True)
+            except subprocess.CalledProcessError:
+                invalid.append("{}.{}".format(table, name))
+        return invalid
+
+    def _referencing_tables(self, schema):
+        """
+        Retorna as tabelas de outros schemas que referenciam(direta ou
+        indiretamente) as tabelas de schema.
+        """
+        sql = "WITH RECURSIVE refs(relid) AS (SELECT c.oid FROM pg_class c "
+        sql += "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        sql += "WHERE n.nspname = '{0}' AND c.relkind = 'r' UNION "
+        sql += "SELECT k.conrelid FROM pg_constraint k "
+        sql += "JOIN refs r ON k.confrelid = r.relid WHERE k.contype = 'f') "
+        sql += "SELECT quote_ident(n.nspname) || '.' || "
+        sql += "quote_ident(c.relname) "
+        sql += "FROM refs r JOIN pg_class c ON c.oid = r.relid "
+        sql += "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        sql += "WHERE n.nspname <> '{0}' ORDER BY 1"
+        return query(sql.format(schema), self.database_name).split()
+
+    def _load_schema_sql(self, filename, schema):
+        """
+        Carrega somente os comandos de um arquivo sql que alteram schema.
+
+        Comandos que escrevem em tabelas de outro schema do sigma(arquivos
+        que usam mais de uma variável {schema_<nome>}) são ignorados, para
+        não duplicar os dados daquele schema.
+        """
+        others = [name for name in INTERPOLATION_VALUES["schemas"].values()
+                  if name != schema]
+        with open(filename, "r") as sql_file:
+            sql = sql_file.read().format(**self.variables)
+        statements = []
+        for statement in split_sql(sql):
+            command = re.sub(r"^(?:\s|--[^\n]*)*", "", statement)
+            match = self.seed_statement.match(command)
+            if match is not None:
+                target = match.group(2).replace('"', "").lower()
+                if target.split(".")[0] in others and "." in target:
+                    continue
+            statements.append(statement)
+        sql_temp = NamedTemporaryFile(delete=False)
+        sql_temp.write(bytes("".join(statements), "utf-8"))
+        sql_temp.close()
+        cmd = "psql -h localhost -U postgres -d {} -f {}"
+        call(cmd.format(self.database_name, sql_temp.name), True)
+
+    def _save_schema_snapshot(self, schema, snapshot):
+        """
+        Salva os dados do schema para acelerar as próximas restaurações.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        prefix = os.path.join(self.cache_dir, schema + "_")
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if path.startswith(prefix) and path.endswith(".dump"):
+                os.remove(path)
+        print_info("Salvando snapshot do schema {}...".format(schema))
+        cmd = "pg_dump -h localhost -U postgres -Fc --data-only -n {} -f {} {}"
+        call(cmd.format(schema, snapshot, self.database_name))
+
+    def _schema_tables(self):
+        """
+        Retorna as tabelas(schema.tabela) dos schemas do sigma.
+        """
+        schemas = ", ".join("'{}'".format(schema) for schema
+                            in INTERPOLATION_VALUES["schemas"].values())
+        sql = "SELECT c.oid::regclass::text FROM pg_class c "
+        sql += "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        sql += "WHERE c.relkind = 'r' AND n.nspname IN ({}) ORDER BY 1"
+        return query(sql.format(schemas), self.database_name).split()
+
+    def _foreign_keys(self):
+        """
+        Retorna as chaves estrangeiras das tabelas dos schemas do sigma.
+
+        Cada item é uma tupla (tabela, colunas, tabela referenciada, colunas
+        referenciadas). As colunas são listas na ordem da constraint.
+        """
+        schemas = ", ".join("'{}'".format(schema) for schema
+                            in INTERPOLATION_VALUES["schemas"].values())
+        columns = "(SELECT string_agg(quote_ident(a.attname), ',' "
+        columns += "ORDER BY k.n) FROM unnest(c.{0}) WITH ORDINALITY "
+        columns += "k(attnum, n) JOIN pg_attribute a ON a.attrelid = c.{1} "
+        columns += "AND a.attnum = k.attnum)"
+        sql = "SELECT c.conrelid::regclass::text, "
+        sql += columns.format("conkey", "conrelid") + ", "
+        sql += "c.confrelid::regclass::text, "
+        sql += columns.format("confkey", "confrelid") + " "
+        sql += "FROM pg_constraint c JOIN pg_namespace n "
+        sql += "ON n.oid = c.connamespace "
+        sql += "WHERE c.contype = 'f' AND n.nspname IN ({})"
+        foreign_keys = []
+        for line in query(sql.format(schemas), self.database_name).splitlines():
+            table, cols, parent, parent_cols = line.split("|")
+            foreign_keys.append((table, cols.split(","),
+                                 parent, parent_cols.split(",")))
+        return foreign_keys
+
+    def _dependency_levels(self, tables, foreign_keys):
+        """
+        Agrupa as tabelas em níveis de dependência.
+
+        As tabelas de um nível dependem somente de tabelas de níveis
+        anteriores, portanto as tabelas de um mesmo nível são independentes.
+        """
+        pending = set(tables)
+        parents = {table: set() for table in tables}
+        for table, _, parent, _ in foreign_keys:
+            if table in parents and parent in parents and parent != table:
+                parents[table].add(parent)
+        levels = []
+        while pending:
+            level = sorted(table for table in pending
+                           if not parents[table] & pending)
+            if not level:
+                # Dependência circular: carrega o restante junto.
+                level = sorted(pending)
+            levels.append(level)
+            pending -= set(level)
+        return levels
+
+    @traced
+    def generate_data(self):
+        """
+        Gera dados sintéticos proporcionais aos dados de desenvolvimento.
+
+        Cada tabela dos schemas do sigma passa a ter data_scale vezes o número
+        de linhas carregadas pelos arquivos sql. As novas linhas são sorteadas
+        entre as linhas existentes(preservando a distribuição dos valores),
+        com chaves primárias/únicas renovadas e chaves estrangeiras sorteadas
+        entre as linhas da tabela referenciada. Linhas que repetiriam uma
+        chave após generate_attempts sorteios são descartadas. As tabelas de
+        um mesmo nível de dependência são carregadas em paralelo via COPY.
+        """
+        msg = "Gerando dados sintéticos(escala {})...".format(self.data_scale)
+        print_info(msg)
+        foreign_keys = self._foreign_keys()
+        levels = self._dependency_levels(self._schema_tables(), foreign_keys)
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+            for level in levels:
+                jobs = [executor.submit(self._generate_table_data, table,
+                                        foreign_keys) for table in level]
+                for table, job in zip(level, jobs):
+                    try:
+                        rows = job.result()
+                    except subprocess.CalledProcessError:
+                        msg = "Não foi possível gerar dados para {}."
+                        print_warning(msg.format(table))
+                    else:
+                        msg = "{}: {} linhas geradas.".format(table, rows)
+                        print_info(msg)
+
+    def _generate_table_data(self, table, foreign_keys):
+        """
+        Gera e carrega os dados sintéticos de uma tabela.
+
+        Retorna o número de linhas geradas.
+        """
+        database = self.database_name
+        count = int(query("SELECT count(*) FROM {}".format(table), database))
+        if count == 0:
+            # Sem dados de desenvolvimento não há distribuição para seguir.
+            return 0
+        sql = "SELECT quote_ident(a.attname), t.typname, t.typcategory, "
+        sql += "coalesce(pg_get_expr(d.adbin, d.adrelid) LIKE 'nextval(%', "
+        sql += "false), CASE WHEN t.typcategory = 'S' AND a.atttypmod > 4 "
+        sql += "THEN a.atttypmod - 4 ELSE 0 END FROM pg_attribute a "
+        sql += "JOIN pg_type t ON t.oid = a.atttypid "
+        sql += "LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid "
+        sql += "AND d.adnum = a.attnum WHERE a.attrelid = '{}'::regclass "
+        sql += "AND a.attnum > 0 AND NOT a.attisdropped ORDER BY a.attnum"
+        columns = []
+        types = {}
+        lengths = {}
+        for line in query(sql.format(table), database).splitlines():
+            name, typname, category, serial, length = line.split("|")
+            if serial != "t":
+                columns.append(name)
+                types[name] = (typname, category)
+                lengths[name] = int(length)
+        positions = {name: columns.index(name) for name in columns}
+        sql = "SELECT string_agg(quote_ident(a.attname), ',') "
+        sql += "FROM pg_constraint c JOIN pg_attribute a "
+        sql += "ON a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey) "
+        sql += "WHERE c.conrelid = '{}'::regclass AND c.contype IN ('p', 'u') "
+        sql += "GROUP BY c.oid"
+        constraints = [line.split(",") for line
+                       in query(sql.format(table), database).splitlines()]
+        # Chaves cujas colunas não são todas inseridas(serial) não repetem.
+        constraints = [cols for cols in constraints
+                       if all(col in columns for col in cols)]
+
+        sql = "SELECT {} FROM {} ORDER BY random() LIMIT 1000"
+        sample = copy_out(sql.format(", ".join(columns), table), database)
+        references = []
+        fk_columns = set()
+        for child, cols, parent, parent_cols in foreign_keys:
+            if child != table:
+                continue
+            fk_columns.update(cols)
+            if parent == table:
+                continue
+            fk_positions = [positions[col] for col in cols if col in columns]
+            if len(fk_positions) != len(cols):
+                continue
+            sql = "SELECT DISTINCT {} FROM {}".format(", ".join(parent_cols),
+                                                     parent)
+            references.append((fk_positions, copy_out(sql, database)))
+
+        # As colunas de chaves estrangeiras nunca são renovadas: uma chave
+        # composta só de chaves estrangeiras recebe combinações de pais
+        # ainda não usadas.
+        renewable = set(col for cols in constraints for col in cols
+                        if col not in fk_columns)
+        maximums = {}
+        for name in renewable:
+            if types[name][1] == "N":
+                sql = "SELECT coalesce(max({}), 0)::bigint FROM {}"
+                maximums[name] = int(query(sql.format(name, table), database))
+            elif types[name][0] in ["date", "timestamp", "timestamptz"]:
+                sql = "SELECT coalesce(extract(epoch FROM max({})), 0) "
+                sql += "FROM {}"
+                maximums[name] = float(query(sql.format(name, table),
+                                             database))
+        used = []
+        for cols in constraints:
+            sql = "SELECT {} FROM {}".format(", ".join(cols), table)
+            used.append(set(tuple(line) for line in copy_out(sql, database)))
+        generated = [0]
+
+        def renew(name, value, number):
+            typname, category = types[name]
+            if typname in ["date", "timestamp", "timestamptz"]:
+                step = 86400 if typname == "date" else 1
+                moment = datetime.datetime.utcfromtimestamp(
+                    maximums[name] + number * step)
+                if typname == "date":
+                    return moment.strftime("%Y-%m-%d")
+                return moment.strftime("%Y-%m-%d %H:%M:%S+00")
+            elif name in maximums:
+                return str(maximums[name] + number)
+            elif typname == "uuid":
+                return str(uuid.uuid4())
+            elif category == "S" and value != "\\N":
+                suffix = "_{}".format(number)
+                if lengths[name] > 0:
+                    if len(suffix) > lengths[name]:
+                        suffix = "{:x}".format(number)[-lengths[name]:]
+                    value = value[:lengths[name] - len(suffix)]
+                    # Não corta uma sequência de escape do COPY ao meio.
+                    while (len(value) - len(value.rstrip("\\"))) % 2 == 1:
+                        value = value[:-1]
+                return value + suffix
+            return value
+
+        def rows():
+            number = 0
+            for _ in range(count * (self.data_scale - 1)):
+                for _ in range(self.generate_attempts):
+                    number += 1
+                    row = list(random.choice(sample))
+                    for fk_positions, values in references:
+                        if values:
+                            for position, value in zip(fk_positions,
+                                                       random.choice(values)):
+                                row[position] = value
+                    for name in renewable:
+                        position = positions[name]
+                        row[position] = renew(name, row[position], number)
+                    keys = [tuple(row[positions[col]] for col in cols)
+                            for cols in constraints]
+                    # Valores nulos não violam chaves únicas.
+                    if any(key in values and "\\N" not in key
+                           for key, values in zip(keys, used)):
+                        continue
+                    for key, values in zip(keys, used):
+                        values.add(key)
+                    generated[0] += 1
+                    yield "\t".join(row) + "\n"
+                    break
+
+        copy_in(table, columns, rows(), database)
+        return generated[0]
+
+    def _test_database_name(self, index):
+        return "{}_test_{}".format(self.database_name, index)
+
+    @traced
+    def finalize_database(self):
+        """
+        Prepara o banco carregado para as primeiras consultas.
+
+        Executa VACUUM ANALYZE, em paralelo, nas tabelas dos schemas do sigma
+        para que o planejador tenha estatísticas e, com --prewarm, carrega no
+        shared_buffers as relações mais acessadas durante a carga.
+        """
+        schemas = ", ".join("'{}'".format(schema) for schema
+                            in INTERPOLATION_VALUES["schemas"].values())
+        sql = "SELECT c.oid::regclass::text FROM pg_class c "
+        sql += "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        sql += "WHERE c.relkind = 'r' AND n.nspname IN ({}) "
+        sql += "ORDER BY pg_total_relation_size(c.oid) DESC"
+        tables = query(sql.format(schemas), self.database_name).split()
+        start = time.time()
+        # As maiores tabelas primeiro, para equilibrar as conexões.
+        with ThreadPoolExecutor(max_workers=self._jobs()) as executor:
+            list(executor.map(lambda table: query("VACUUM ANALYZE " + table,
+                                                  self.database_name),
+                              tables))
+        msg = "VACUUM ANALYZE de {} tabelas em {}."
+        print_info(msg.format(len(tables),
+                              format_duration(time.time() - start)))
+        if self.prewarm is True:
+            self._prewarm(schemas)
+
+    def _prewarm(self, schemas):
+        """
+        Carrega no cache as tabelas(e seus índices) mais acessadas.
+
+        As relações são escolhidas pelo número de leituras registradas em
+        pg_stat_user_tables até ocupar o shared_buffers.
+        """
+        try:
+            query("CREATE EXTENSION IF NOT EXISTS pg_prewarm",
+                  self.database_name)
+        except subprocess.CalledProcessError:
+            print_warning("Extensão pg_prewarm indisponível, cache não "
+                          "carregado.")
+            return
+        hits = "t.seq_scan + coalesce(t.idx_scan, 0)"
+        relations = "SELECT t.relid AS oid, {1} AS hits "
+        relations += "FROM pg_stat_user_tables t "
+        relations += "WHERE t.schemaname IN ({0}) UNION ALL "
+        relations += "SELECT i.indexrelid, {1} FROM pg_stat_user_tables t "
+        relations += "JOIN pg_index i ON i.indrelid = t.relid "
+        relations += "WHERE t.schemaname IN ({0})"
+        ranked = "SELECT oid, sum(pg_relation_size(oid)) OVER "
+        ranked += "(ORDER BY hits DESC, oid) AS total FROM ({}) r"
+        sql = "SELECT count(*), coalesce(sum(pg_prewarm(oid)), 0) * "
+        sql += "current_setting('block_size')::bigint FROM ({}) h "
+        # shared_buffers é medido em blocos.
+        sql += "WHERE total <= (SELECT setting::bigint * "
+        sql += "current_setting('block_size')::bigint FROM pg_settings "
+        sql += "WHERE name = 'shared_buffers')"
+        sql = sql.format(ranked.format(relations.format(schemas, hits)))
+        start = time.time()
+        count, size = query(sql, self.database_name).split("|")
+        msg = "{} relações({}MB) carregadas no cache em {}."
+        print_info(msg.format(count, int(size) // 2 ** 20,
+                              format_duration(time.time() - start)))
+
+    @traced
+    def create_test_databases(self):
+        """
+        Cria cópias numeradas do banco de desenvolvimento para testes.
+
+        As cópias são criadas com CREATE DATABASE ... TEMPLATE, portanto o
+        banco de desenvolvimento não pode ter conexões abertas. Para cada
+        cópia é gerado um arquivo .ini apontando para o banco correspondente.
+        """
+        self.remove_test_databases()
+        msg = "Criando {} bancos de dados de teste...".format(self.test_databases)
+        print_info(msg)
+        # O template não pode ter conexões abertas.
+        self.drain_database(keep_blocked=True)
+        sql = ""
+        for index in range(1, self.test_databases + 1):
+            sql += "CREATE DATABASE {} TEMPLATE {};\n".format(
+                self._test_database_name(index), self.database_name)
+        try:
+            query(sql)
+        finally:
+            self._allow_connections(self.database_name, True)
+        for index in range(1, self.test_databases + 1):
+            ini_file = self.test_ini_file.format(index)
+            config = configparser.RawConfigParser()
+            config.read(self.ini_file)
+            config.set("sigma:database", "name", self._test_database_name(index))
+            with open(ini_file, "w") as config_file:
+                config.write(config_file)
+            msg = "Banco " + Colors.BOLD + "{}" + Colors.ENDC + Colors.GREEN
+            msg += " => {}"
+            print_info(msg.format(self._test_database_name(index), ini_file))
+
+    @traced
+    def remove_test_databases(self):
+        """
+        Exclui todos os bancos de teste e, após a exclusão, seus arquivos
+        .ini.
+        """
+        pattern = self._test_database_name("%").replace("_", "\\_")
+        sql = "SELECT datname FROM pg_database WHERE datname LIKE '{}'"
+        names = query(sql.format(pattern)).split()
+        if not names:
+            return
+        print_info("Excluindo {} bancos de dados de teste...".format(len(names)))
+        sql = ""
+        for name in names:
+            self.drain_database(name, keep_blocked=True)
+            sql += "DROP DATABASE IF EXISTS {};\n".format(name)
+        try:
+            query(sql)
+        except subprocess.CalledProcessError:
+            # Os bancos que não foram excluídos voltam a aceitar conexões.
+            for name in names:
+                self._allow_connections(name, True)
+            raise
+        finally:
+            # Os .ini só são removidos junto com os seus bancos.
+            sql = "SELECT datname FROM pg_database WHERE datname LIKE '{}'"
+            remaining = query(sql.format(pattern)).split()
+            for name in names:
+                ini_file = self.test_ini_file.format(name.rsplit("_", 1)[-1])
+                if name not in remaining and os.path.exists(ini_file):
+                    os.remove(ini_file)
 
     def _pre_process_sql(self, filename):
         """
@@ -694,49 +3467,84 @@ class Prepdev():
         sql_temp.seek(0)
         return sql_temp.name
 
+    @traced
     def make_commands(self):
         """
         Cria os comandos personalizados.
 
-        Os comandos nada mais são do que alias criados no arquivo ~/.bashrc.
+        Os comandos do sigma são scripts(shims) em um diretório próprio que
+        executam diretamente os programas do ambiente virtual, sem ativá-lo.
+        O ~/.bashrc recebe um único bloco delimitado, reescrito no lugar a
+        cada execução, que inclui esse diretório no PATH e cria os alias
+        sigma e sigmalib.
         """
         print_info("Criando comandos personalizados...")
-        comment = "\n# Alias criado pelo comando prepdev do sigma.\n"
-        sigma = "alias sigma='{} cd {}'"
-        sigma = sigma.format(self.activate_venv, self.sigma_path)
-        sigmalib = "alias sigmalib='{} cd {}'"
-        sigmalib = sigmalib.format(self.activate_venv, self.sigmalib_path)
-        prepdev = "alias prepdev='{}/prepdev.py'".format(self.base_path)
-        sigma_help = "alias sigma_help='{}/prepdev.py --sigma-help'"
-        sigma_help = sigma_help.format(self.base_path)
-        if os.path.exists(self.bashrc) is True:
-            with open(self.bashrc, "r+") as f:
-                # Se o alias ainda não foi criado. Crie-o.
-                if sigma not in f.read():
-                    f.write(comment)
-                    f.write(sigma)
-                    f.write("\n")
-                f.seek(0)
-                if sigmalib not in f.read():
-                    f.write(sigmalib)
-                    f.write("\n")
-                f.seek(0)
-                if prepdev not in f.read():
-                    f.write(prepdev)
-                    f.write("\n")
-                f.seek(0)
-                if sigma_help not in f.read():
-                    f.write(sigma_help)
-                    f.write("\n")
+        self._write_shims()
+        block = [self.bashrc_begin,
+                 "# Bloco gerenciado pelo prepdev. Não edite: ele é reescrito "
+                 "a cada execução.",
+                 'export PATH="{}:$PATH"'.format(self.shims_path),
+                 "alias sigma='{} cd {}'".format(self.activate_venv,
+                                                 self.sigma_path),
+                 "alias sigmalib='{} cd {}'".format(self.activate_venv,
+                                                    self.sigmalib_path),
+                 self.bashrc_end]
+        bashrc = os.path.realpath(self.bashrc)
+        lines = []
+        if os.path.exists(bashrc) is True:
+            with open(bashrc, "r") as f:
+                lines = f.read().splitlines()
+        begin = end = None
+        if self.bashrc_begin in lines:
+            begin = lines.index(self.bashrc_begin)
+        if self.bashrc_end in lines[(begin or 0):]:
+            end = lines.index(self.bashrc_end, begin or 0)
+        if begin is not None and end is not None:
+            lines[begin:end + 1] = block
         else:
-            with open(self.bashrc, "w") as f:
-                f.write(comment)
-                f.write(sigma)
-                f.write("\n")
-                f.write(sigmalib)
-                f.write("\n")
-                f.write(prepdev)
-                f.write("\n")
+            # Sem um bloco completo(ex.: marcador removido à mão) remove
+            # somente as linhas idênticas às geradas pelo prepdev, atuais ou
+            # de versões anteriores, e os marcadores soltos.
+            generated = set(block) | set(self._legacy_lines())
+            lines = [line for line in lines if line not in generated]
+            while lines and lines[-1] == "":
+                lines.pop()
+            lines += [""] + block
+        write_atomic(bashrc, "\n".join(lines) + "\n")
+
+    def _legacy_lines(self):
+        """
+        Retorna as linhas criadas no ~/.bashrc por versões anteriores do
+        prepdev.
+        """
+        prepdev = "{}/prepdev.py".format(self.base_path)
+        return ["# Alias criado pelo comando prepdev do sigma.",
+                "alias sigma='{} cd {}'".format(self.activate_venv,
+                                                self.sigma_path),
+                "alias sigmalib='{} cd {}'".format(self.activate_venv,
+                                                   self.sigmalib_path),
+                "alias prepdev='{}'".format(prepdev),
+                "alias sigma_help='{} --sigma-help'".format(prepdev)]
+
+    def _write_shims(self):
+        """
+        Cria um executável para cada comando do sigma.
+        """
+        os.makedirs(self.shims_path, exist_ok=True)
+        shims = {}
+        for command in self.venv_commands:
+            target = os.path.join(self.venv_path, "bin", command)
+            shims[command] = 'exec "{}" "$@"'.format(target)
+        prepdev = os.path.join(self.base_path, "prepdev.py")
+        shims["prepdev"] = 'exec python3 "{}" "$@"'.format(prepdev)
+        shims["sigma_help"] = 'exec python3 "{}" --sigma-help "$@"'.format(
+            prepdev)
+        for name in os.listdir(self.shims_path):
+            if name not in shims:
+                os.remove(os.path.join(self.shims_path, name))
+        for name, command in shims.items():
+            shim = os.path.join(self.shims_path, name)
+            write_atomic(shim, "#!/bin/sh\n{}\n".format(command), 0o755)
 
     def finish(self):
         """
@@ -828,7 +3636,7 @@ class Prepdev():
         msg += "Você já configurou o postgresql para aceitar conexões do "
         msg += "localhost(127.0.0.1) como confiáveis? (s/" + Colors.BOLD + "[N]"
         msg += Colors.ENDC + Colors.WARNING + ")" + Colors.ENDC
-        answer = input(msg)
+        answer = self.ask("pg_hba_configured", msg)
         if answer == "":
             answer = "n"
         if answer in self.positive_answer:
@@ -859,19 +3667,12 @@ class Prepdev():
         Quando existe mais de uma versão compatível com o sigma, solicita que o
         usuário escolha qual deseja utilizar.
         """
-        versions = os.listdir(self.postgres_config_base_path)
+        base = self.postgres_config_base_path
+        versions = self.probe.get("postgresql_versions", [base],
+                                  lambda: sorted(os.listdir(base)))
         valid_versions = []
         if len(versions) > 1:
-            required_major_version = self._valid_postgresql_major_versions()
-            required_minor_version = self._valid_postgresql_minor_versions()
-            # Verifica qual das versões instaladas é válida.
-            for version in versions:
-                major = int(version.split(".")[0])
-                minor = int(version.split(".")[1])
-                conditions = [major >= required_major_version,
-                              minor >= required_minor_version]
-                if all(conditions):
-                    valid_versions.append(version)
+            valid_versions = self._valid_postgresql_versions(versions)
             if len(valid_versions) == 0:
                 msg = "Não foi encontrada uma versão válida do postgresql."
                 msg += "A versão mínima exigida é: {}"
@@ -886,25 +3687,34 @@ class Prepdev():
                     msg = "Opção {} - versão {}".format(index + 1,
                                                   valid_versions[index])
                     print_blue(msg)
-                while True:
-                    msg = "Qual versão você deseja utilizar? "
-                    answer = input(msg)
-                    try:
-                        answer = int(answer)
-                        if answer > len(valid_versions):
-                            raise Exception
-                        if answer < 1:
-                            raise Exception
-                    except Exception:
-                        print_error("Opção inválida.")
-                    else:
-                        break
-                self.postgres_version = valid_versions[answer-1]
+                version = self._choose("postgresql_version", valid_versions)
+                if version is None:
+                    msg = "A versão {} não é uma das versões compatíveis: {}"
+                    msg = msg.format(self.answers["postgresql_version"],
+                                     ", ".join(valid_versions))
+                    raise InvalidPostgresqlVersionError(msg)
+                self.postgres_version = version
             else:
                 self.postgres_version = valid_versions[0]
         else:
             self.postgres_version = versions[0]
 
+    def _valid_postgresql_versions(self, versions):
+        """
+        Retorna as versões instaladas compatíveis com o sigma.
+        """
+        required_major_version = self._valid_postgresql_major_versions()
+        required_minor_version = self._valid_postgresql_minor_versions()
+        valid_versions = []
+        for version in versions:
+            major = int(version.split(".")[0])
+            minor = int(version.split(".")[1])
+            conditions = [major >= required_major_version,
+                          minor >= required_minor_version]
+            if all(conditions):
+                valid_versions.append(version)
+        return valid_versions
+
     def set_postgresql_cluster(self):
         """
         Solicita que o usuário escolha o cluster do postgresql que deseja usar.
@@ -916,7 +3726,9 @@ class Prepdev():
         self.set_postgresql_version()
         self.postgres_cluster = os.path.join(self.postgres_config_base_path,
                                              self.postgres_version)
-        clusters = os.listdir(self.postgres_cluster)
+        path = self.postgres_cluster
+        clusters = self.probe.get("postgresql_clusters:" + path, [path],
+                                  lambda: sorted(os.listdir(path)))
         if len(clusters) > 1:
             msg = "Você possui {} clusters do postgresql configurados. "
             msg += "Por favor informe qual o sigma deve utilizar:"
@@ -926,21 +3738,14 @@ class Prepdev():
                 msg = "Opção {} - cluster {}".format(index + 1,
                                                      clusters[index])
                 print_blue(msg)
-            while True:
-                msg = "Qual cluster você deseja utilizar? "
-                answer = input(msg)
-                try:
-                    answer = int(answer)
-                    if answer > len(clusters):
-                        raise Exception
-                    if answer < 1:
-                        raise Exception
-                except Exception:
-                    print_error("Opção inválida.")
-                else:
-                    break
+            cluster = self._choose("postgresql_cluster", clusters)
+            if cluster is None:
+                msg = "O cluster {} não existe. Clusters disponíveis: {}"
+                msg = msg.format(self.answers["postgresql_cluster"],
+                                 ", ".join(clusters))
+                raise InvalidPostgresqlClusterError(msg)
             self.postgres_cluster = os.path.join(self.postgres_cluster,
-                                                 clusters[answer-1])
+                                                 cluster)
         elif len(clusters) == 0:
             msg = "Não foi encontrado nenhum cluster para versão {}. "
             msg += "Verifique sua instalação do postgresql e tente novamente."
@@ -957,6 +3762,7 @@ class Prepdev():
         self.set_postgresql_cluster()
         self.postgres_pghba = os.path.join(self.postgres_cluster, "pg_hba.conf")
 
+    @traced
     def configure_postgresql(self):
         """
         Realiza todas as configurações necessárias no postgresql.
@@ -967,9 +3773,12 @@ class Prepdev():
         TODO: Quando houver mais de um subdiretório dentro de /etc/postgresql
         o usuário deve informar qual deseja utilizar.
         """
+        self.probe_environment()
         self.set_postgresql_pg_hba()
         pghba_group = get_file_group(self.postgres_pghba)
-        user_groups = get_additional_groups_name(self.current_user)
+        user_groups = self.probe.get(
+            "groups:" + self.current_user, ["/etc/group", "/etc/passwd"],
+            lambda: get_additional_groups_name(self.current_user))
 
         if pghba_group not in user_groups:
             msg = "Adicionando usuário {} ao grupo {}"
@@ -978,43 +3787,54 @@ class Prepdev():
             add_user_to_group(self.current_user, pghba_group)
 
         if os.path.exists(self.postgres_pghba) is True:
-            DATABASE = 1
-            USER = 2
-            HOST = 3
-            METHOD = 4
-            local_access = False
-            trust_access = False
-            with open(self.postgres_pghba, "r") as pg_hba:
-                for line in pg_hba.readlines():
-                    database = False
-                    user = False
-                    host = False
-                    line = line.strip()
-                    required_hosts = ["127.0.0.1", "0.0.0.0", "127.0.0.1/32"]
-                    if not line.startswith("#") and line.startswith("host"):
-                        line = " ".join(line.split()).split()
-                        if line[METHOD] == "trust":
-                            if line[DATABASE] in ["all", self.database_name]:
-                                database = True
-                            if line[USER] in ["postgres"]:
-                                user = True
-                            if line[HOST] in required_hosts:
-                                host = True
-                            if all([database, user, host]):
-                                trust_access = True
-                        elif line[METHOD] == "md5":
-                            if line[DATABASE] in ["all", self.database_name]:
-                                database = True
-                            if line[USER] in ["all"]:
-                                user = True
-                            if line[HOST] in required_hosts:
-                                host = True
-                            if all([database, user, host]):
-                                local_access = True
+            name = "pg_hba:{}:{}".format(self.postgres_pghba, self.database_name)
+            local_access, trust_access = self.probe.get(
+                name, [self.postgres_pghba], self._pg_hba_access)
             if local_access is False or trust_access is False:
                 self.postgres_warning(local_access, trust_access)
                 sys.exit(-1)
 
+    def _pg_hba_access(self):
+        """
+        Verifica as entradas do pg_hba.conf necessárias ao sigma.
+
+        Retorna uma lista [acesso md5 local, acesso trust do postgres].
+        """
+        DATABASE = 1
+        USER = 2
+        HOST = 3
+        METHOD = 4
+        local_access = False
+        trust_access = False
+        with open(self.postgres_pghba, "r") as pg_hba:
+            for line in pg_hba.readlines():
+                database = False
+                user = False
+                host = False
+                line = line.strip()
+                required_hosts = ["127.0.0.1", "0.0.0.0", "127.0.0.1/32"]
+                if not line.startswith("#") and line.startswith("host"):
+                    line = " ".join(line.split()).split()
+                    if line[METHOD] == "trust":
+                        if line[DATABASE] in ["all", self.database_name]:
+                            database = True
+                        if line[USER] in ["postgres"]:
+                            user = True
+                        if line[HOST] in required_hosts:
+                            host = True
+                        if all([database, user, host]):
+                            trust_access = True
+                    elif line[METHOD] == "md5":
+                        if line[DATABASE] in ["all", self.database_name]:
+                            database = True
+                        if line[USER] in ["all"]:
+                            user = True
+                        if line[HOST] in required_hosts:
+                            host = True
+                        if all([database, user, host]):
+                            local_access = True
+        return [local_access, trust_access]
+
     def important_warning(self):
         msg = "Este script não deve ser executado em ambiente de produção!"
         print_warning(msg, bold=True)
@@ -1028,44 +3848,510 @@ class Prepdev():
         return exist
 
     def run(self):
+        """
+        Executa o modo escolhido na linha de comando.
+
+        Retorna o código de saída do prepdev(o retorno do último passo).
+        """
+        if self.show_plan is True:
+            self.print_plan()
+            return
+        if self.run_doctor is True:
+            try:
+                return self.doctor()
+            finally:
+                self.probe.save()
+        results = self.run_steps(self.only, self.skip)
+        if results:
+            return results[-1].value
+
+    def _check_packages(self):
+        missing_packages = self._missing_packages()
+        if missing_packages:
+            msg = "Pacote(s) indisponível(is): {}. Execute: sudo apt-get update"
+            return [msg.format(", ".join(missing_packages))]
+        return []
+
+    def _check_postgresql(self):
+        problems = []
+        try:
+            self.check_postgresql_version()
+        except InvalidPostgresqlVersionError as exc:
+            problems.append(str(exc))
+        except (OSError, subprocess.CalledProcessError):
+            problems.append("psql não encontrado.")
+        host = self.config["sigma:database"]["host"]
+        port = self.config["sigma:database"]["port"]
+        cmd = ["pg_isready", "-q", "-h", host, "-p", port, "-U", "postgres"]
+        try:
+            ready = subprocess.call(cmd, timeout=self.doctor_timeout) == 0
+        except (OSError, subprocess.TimeoutExpired):
+            ready = False
+        if ready is False:
+            msg = "O banco de dados não está aceitando conexões em {}:{}."
+            problems.append(msg.format(host, port))
+        return problems
+
+    def _check_pg_hba(self):
+        problems = []
+        pghba_group = get_file_group(self.postgres_pghba)
+        user_groups = get_additional_groups_name(self.current_user)
+        if pghba_group not in user_groups:
+            msg = "O usuário {} não pertence ao grupo {}."
+            problems.append(msg.format(self.current_user, pghba_group))
+        try:
+            local_access, trust_access = self._pg_hba_access()
+        except PermissionError:
+            msg = "Sem permissão de leitura em {}."
+            problems.append(msg.format(self.postgres_pghba))
+        else:
+            if trust_access is False:
+                msg = "Falta a entrada trust do usuário postgres em {}."
+                problems.append(msg.format(self.postgres_pghba))
+            if local_access is False:
+                msg = "Falta a entrada md5 para 127.0.0.1 em {}."
+                problems.append(msg.format(self.postgres_pghba))
+        return problems
+
+    def _check_github(self):
+        if self.local_repo_exists() is True:
+            return []
+        problems = []
+        if os.path.exists(self.sigma_pub_key) is False:
+            problems.append("A chave ssh do sigma não existe.")
+        elif self.github_sigma_configured(self.doctor_timeout) is False:
+            problems.append("O github não aceita a chave ssh do sigma.")
+        if os.path.exists(self.sigmalib_pub_key) is False:
+            problems.append("A chave ssh do sigmalib não existe.")
+        elif self.github_sigmalib_configured(self.doctor_timeout) is False:
+            problems.append("O github não aceita a chave ssh do sigmalib.")
+        return problems
+
+    def _check_venv(self):
+        if os.path.exists(self.venv_path) is False:
+            return []
+        try:
+            cmd = [self.python, "-c", "import sys"]
+            broken = subprocess.call(cmd, timeout=self.doctor_timeout) != 0
+        except (OSError, subprocess.TimeoutExpired):
+            broken = True
+        if broken is True:
+            msg = "O ambiente virtual {} está quebrado. Exclua-o e execute "
+            msg += "o prepdev novamente."
+            return [msg.format(self.venv_path)]
+        return []
+
+    def doctor(self):
+        """
+        Verifica, de uma só vez e em paralelo, as pré-condições do prepdev.
+
+        Nada é perguntado ao usuário: uma escolha sem resposta(ex.: mais de
+        um cluster do postgresql) é reportada como problema. Cada verificação
+        executa em uma thread daemon, assim uma verificação travada é
+        reportada após o seu tempo limite(cerca de doctor_timeout segundos e
+        doctor_apt_timeout para a dos pacotes) e não impede o término do
+        processo.
+
+        Retorna 0 quando nenhum problema é encontrado e 1 caso contrário.
+        """
+        self._set_paths(self._planned_repository_path())
+        checks = {"pacotes": self._check_packages,
+                  "postgresql": self._check_postgresql,
+                  "github": self._check_github,
+                  "ambiente virtual": self._check_venv}
+        problems = {}
+        batch = self.batch
+        self.batch = True
+        try:
+            self.set_postgresql_pg_hba()
+        except (OSError, InvalidPostgresqlVersionError,
+                InvalidPostgresqlClusterError, MissingAnswerError) as exc:
+            problems["pg_hba.conf"] = [str(exc)]
+        else:
+            checks["pg_hba.conf"] = self._check_pg_hba
+        finally:
+            self.batch = batch
+        results = {}
+        threads = {}
+        for name, check in checks.items():
+            threads[name] = threading.Thread(target=self._run_check,
+                                             args=(name, check, results),
+                                             daemon=True)
+            threads[name].start()
+        start = time.monotonic()
+        for name, thread in threads.items():
+            timeout = self.doctor_timeout + 1
+            if name == "pacotes":
+                timeout = self.doctor_apt_timeout
+            thread.join(max(start + timeout - time.monotonic(), 0))
+            if thread.is_alive() is True:
+                problems[name] = ["A verificação excedeu o tempo limite."]
+            else:
+                problems[name] = results[name]
+        for name in sorted(problems):
+            if problems[name]:
+                print_error("[falha] {}".format(name), bold=True)
+                for problem in problems[name]:
+                    print_warning("    " + problem)
+            else:
+                print_info("[ok] {}".format(name))
+        if any(problems.values()):
+            return 1
+        return 0
+
+    def _run_check(self, name, check, results):
+        """
+        Executa uma verificação do doctor e guarda os problemas em results.
+        """
+        try:
+            results[name] = check()
+        except Exception as exc:
+            results[name] = ["Falha na verificação: {}".format(exc)]
+
+    def _container_commands(self, recorded, *steps):
+        """
+        Retorna os comandos gravados pelos passos, adaptados ao container.
+        """
+        local = recorded["local_repository"]
+        commands = []
+        for entry in recorded["commands"]:
+            command = entry["command"]
+            if entry["step"] not in steps:
+                continue
+            if "sigmalib.github.com" in command:
+                # O sigmalib é copiado para o contexto e instalado pelo
+                # setup_develop.
+                continue
+            # Somente o diretório local inteiro(e não um prefixo de outro
+            # nome) é trocado.
+            command = re.sub(re.escape(local) + r"(?=[/\s;&|'\"]|$)",
+                             self.container_root, command)
+            # sudo apenas como comando(início ou após &&, ||, ; e |).
+            command = re.sub(r"(^|[;&|]\s*)sudo\s+", r"\1", command)
+            command = command.replace("git+ssh://git@github.com/",
+                                      "git+https://github.com/")
+            commands.append(command)
+        return commands
+
+    def export_container(self):
+        """
+        Exporta o último provisionamento completo como um contexto de build.
+
+        O Dockerfile gerado reproduz os comandos gravados na última execução
+        completa do prepdev. As camadas estão ordenadas da que muda com menor
+        frequência(pacotes do S.O.) para a que muda com maior
+        frequência(código e dados), aproveitando ao máximo o cache do build.
+        O código dos repositórios é copiado para o contexto, portanto o build
+        não precisa de acesso aos repositórios nem a um registry além da
+        imagem base.
+        """
+        if os.path.exists(self.commands_file) is False:
+            msg = "Nenhum provisionamento completo foi gravado. Execute o "
+            msg += "prepdev sem opções antes de exportar."
+            print_error(msg)
+            return 1
+        with open(self.commands_file, "r") as commands_file:
+            recorded = json.load(commands_file)
+        local = recorded["local_repository"]
+        os.makedirs(self.export_dir, exist_ok=True)
+        print_info("Exportando o código dos repositórios...")
+        for name in ["sigmalib", "sigma"]:
+            status = ["git", "-C", os.path.join(local, name), "status",
+                      "--porcelain", "--untracked-files=no"]
+            if subprocess.check_output(status).strip():
+                msg = "{} possui alterações não commitadas, que não são "
+                msg += "exportadas(git archive HEAD)."
+                print_warning(msg.format(os.path.join(local, name)), bold=True)
+            archive = os.path.join(self.export_dir, name + ".tar")
+            cmd = ["git", "-C", os.path.join(local, name), "archive",
+                   "--format=tar", "--prefix={}/".format(name), "-o",
+                   archive, "HEAD"]
+            subprocess.check_call(cmd)
+        shutil.copy(os.path.abspath(__file__), self.export_dir)
+        answers = configparser.RawConfigParser()
+        answers.add_section("answers")
+        answers.set("answers", "repository_path", self.container_root)
+        answers.set("answers", "drop_database", "s")
+        answers.set("answers", "populate_db", "s")
+        with open(os.path.join(self.export_dir, "answers.ini"), "w") as file_:
+            answers.write(file_)
+
+        def run_layer(commands):
+            return "RUN " + " && \\\n    ".join(commands)
+
+        pg_hba = "for f in /etc/postgresql/*/*/pg_hba.conf; do "
+        pg_hba += "sed -i '1i host all all 127.0.0.1/32 md5' $f && "
+        pg_hba += "sed -i '1i host all postgres 127.0.0.1/32 trust' $f; done"
+        seed = ["service postgresql start",
+                "python3 /opt/prepdev/prepdev.py --resetdb --batch "
+                "--answers /opt/prepdev/answers.ini",
+                "service postgresql stop"]
+        # O prepdev roda no python3 da imagem: falha cedo se ele for antigo.
+        python_check = "python3 -c 'import sys; "
+        python_check += "assert sys.version_info >= {}, sys.version'".format(
+            MIN_PYTHON)
+        dependencies = self._container_commands(recorded, "so_dependencies")
+        dependencies.append("apt-get install -y postgresql sudo git "
+                            "python3-apt")
+        dependencies.append(python_check)
+        lines = ["# Gerado pelo prepdev(--export-container).",
+                 "FROM {}".format(self.base_image),
+                 "ENV DEBIAN_FRONTEND=noninteractive",
+                 "# Pacotes do S.O.",
+                 run_layer(["apt-get update"] + dependencies),
+                 run_layer([pg_hba]),
+                 "# Ambiente virtual e ferramentas de empacotamento.",
+                 run_layer(self._container_commands(recorded,
+                                                    "create_venv",
+                                                    "update_packages")),
+                 "# Dependências externas.",
+                 run_layer(self._container_commands(recorded,
+                                                    "install_sigmalib")),
+                 "# Código do sigma e sigmalib.",
+                 "ADD sigmalib.tar sigma.tar {}/".format(self.container_root),
+                 run_layer(self._container_commands(recorded,
+                                                    "setup_develop")),
+                 "# Banco de dados com os dados de desenvolvimento.",
+                 "COPY prepdev.py answers.ini /opt/prepdev/",
+                 run_layer(seed),
+                 "WORKDIR {}/sigma".format(self.container_root)]
+        lines = [line for line in lines if line != "RUN "]
+        dockerfile = os.path.join(self.export_dir, "Dockerfile")
+        with open(dockerfile, "w") as file_:
+            file_.write("\n".join(lines) + "\n")
+        msg = "Contexto de build gerado em {}. Para criar a imagem execute: "
+        msg += "docker build -t sigma-dev {}"
+        print_info(msg.format(self.export_dir, self.export_dir))
+        return 0
+
+    def _steps(self):
+        """
+        Retorna, em ordem, os passos do modo escolhido na linha de comando.
+        """
+        return self._mode_steps()[1]
+
+    def _mode_steps(self):
+        """
+        Retorna o modo escolhido na linha de comando e os seus passos.
+
+        A ordem das condições define a precedência entre as opções(ex.: -c
+        com --tune-postgresql executa e registra o close_connections).
+        """
         if self.close_connections is True:
-            self.important_warning()
-            self.close_db_connections()
+            return "close_connections", ["important_warning",
+                                         "close_db_connections"]
         elif self.sigma_help is True:
-            self.print_help()
+            return "sigma_help", ["print_help"]
+        elif self.stats is True:
+            return "stats", ["print_stats"]
+        elif self.export_dir != "":
+            return "export_container", ["export_container"]
+        elif self.watch_files is True:
+            return "watch", ["set_instalation_path", "watch"]
+        elif self.tune is True:
+            return "tune_postgresql", ["tune_postgresql"]
+        elif self.bundles_output != "":
+            return "create_bundles", ["create_bundles"]
+        elif self.untune is True:
+            return "untune_postgresql", ["untune_postgresql"]
         elif self.resetdb is True:
-            self.important_warning()
-            self.configure_postgresql()
-            self.set_instalation_path()
-            self.check_postgresql_version()
-            self.close_db_connections()
-            self.prepare_database()
-            self.run_migrations()
-            self.populate_db()
-        else:
-            self.important_warning()
-            self.configure_postgresql()
-            self.set_instalation_path()
-            self.check_postgresql_version()
-            self.create_venv()
-            self.search_dependencies()
-            if self.local_repo_exists() is False:
-                self.create_ssh_keys()
-                self.create_ssh_config()
-                self.github_configured()
-            self.so_dependencies()
-            self.clone_sigma()
-            self.clone_sigmalib()
-            self.update_packages()
-            self.setup_develop()
-            self.install_sigmalib()
-            self.close_db_connections()
-            self.prepare_database()
-            self.run_migrations()
-            self.populate_db()
-            self.make_commands()
-            self.finish()
-            self.print_help()
+            return "resetdb", ["important_warning", "configure_postgresql",
+                               "set_instalation_path",
+                               "check_postgresql_version",
+                               "close_db_connections", "prepare_database",
+                               "run_migrations", "populate_db",
+                               "generate_data", "finalize_database",
+                               "create_test_databases"]
+        elif self.reset_schema != "":
+            return "reset_schema", ["important_warning",
+                                    "set_instalation_path",
+                                    "reset_database_schema"]
+        elif self.data_scale > 1:
+            return "data_scale", ["important_warning", "generate_data"]
+        elif self.drop_test_databases is True:
+            return "drop_test_databases", ["remove_test_databases"]
+        elif self.test_databases > 0:
+            return "test_databases", ["important_warning",
+                                      "create_test_databases"]
+        return "full", ["important_warning", "configure_postgresql",
+                        "set_instalation_path", "check_postgresql_version",
+                        "create_venv", "search_dependencies",
+                        "create_ssh_keys", "create_ssh_config",
+                        "github_configured", "so_dependencies",
+                        "clone_sigma", "clone_sigmalib", "update_packages",
+                        "setup_develop", "install_sigmalib",
+                        "close_db_connections", "prepare_database",
+                        "run_migrations", "populate_db", "generate_data",
+                        "finalize_database", "create_test_databases",
+                        "make_commands", "finish", "print_help"]
+
+    def _precondition(self, step):
+        """
+        Avalia, sem efeitos colaterais, se o passo deve ser executado.
+
+        Retorna uma tupla (executa, motivo).
+        """
+        if step in ["create_ssh_keys", "create_ssh_config",
+                    "github_configured"]:
+            if self.local_repo_exists() is True:
+                return False, "repositórios locais já existem"
+        elif step == "create_venv":
+            if os.path.exists(self.venv_path) is True:
+                return False, "ambiente virtual já existe"
+        elif step == "clone_sigma":
+            if os.path.exists(self.sigma_path) is True:
+                return False, "repositório já clonado"
+        elif step == "clone_sigmalib":
+            if os.path.exists(self.sigmalib_path) is True:
+                return False, "repositório já clonado"
+        elif step == "generate_data":
+            if self.data_scale <= 1:
+                return False, "--data-scale não informado"
+        elif step == "create_test_databases":
+            if self.test_databases <= 0:
+                return False, "--test-databases não informado"
+        elif step == "prepare_database":
+            if self._database_exists() is True:
+                return True, "o banco {} será excluído".format(self.database_name)
+            return True, "o banco {} será criado".format(self.database_name)
+        return True, ""
+
+    def plan(self):
+        """
+        Retorna o plano de execução sem executar nenhum passo.
+
+        Cada item é uma tupla (passo, executa, motivo, estimativa). A
+        estimativa é a mediana das execuções anteriores(None quando o passo
+        nunca foi executado).
+        """
+        self._set_paths(self._planned_repository_path())
+        return self._plan(self._selected_steps(self.only, self.skip))
+
+    def _plan(self, steps):
+        """
+        Retorna o plano de execução dos passos informados(veja plan), sem
+        alterar os caminhos já configurados.
+        """
+        try:
+            statistics = self.step_statistics()
+        except sqlite3.Error:
+            statistics = {}
+        plan = []
+        for step in steps:
+            run_step, reason = self._precondition(step)
+            estimate = None
+            if step in statistics:
+                estimate = statistics[step]["p50"]
+            plan.append((step, run_step, reason, estimate))
+        return plan
+
+    def print_plan(self):
+        """
+        Imprime o plano de execução com a duração estimada de cada passo.
+        """
+        total = 0
+        for index, (step, run_step, reason, estimate) in enumerate(self.plan()):
+            if run_step is True:
+                estimate_text = "?"
+                if estimate is not None:
+                    estimate_text = format_duration(estimate)
+                    total += estimate
+                msg = "{:>3}. {:<30} ~{:>8}".format(index + 1, step,
+                                                    estimate_text)
+                if reason:
+                    msg += "  ({})".format(reason)
+                print_blue(msg)
+            else:
+                msg = "{:>3}. {:<30} pulado: {}".format(index + 1, step, reason)
+                print_warning(msg)
+        print_info("Duração estimada: " + format_duration(total), bold=True)
+
+    def _selected_steps(self, only=None, skip=None):
+        """
+        Retorna os passos do modo escolhido restritos por only e skip.
+        """
+        steps = self._steps()
+        only = only or []
+        skip = skip or []
+        unknown = [step for step in only + skip if step not in steps]
+        if unknown:
+            msg = "Passo(s) inválido(s): {}. Passos disponíveis: {}"
+            raise InvalidStepError(msg.format(", ".join(unknown),
+                                              ", ".join(steps)))
+        if only:
+            steps = [step for step in steps if step in only]
+        return [step for step in steps if step not in skip]
+
+    def run_steps(self, only=None, skip=None, progress=None):
+        """
+        Executa os passos do modo escolhido e retorna uma lista de StepResult.
+
+        only e skip restringem os passos executados. Quando
+        set_instalation_path não faz parte da seleção, o diretório dos
+        repositórios é o de --repository-path/.prepdevrc, sem perguntas.
+
+        Assim como pela linha de comando, a saída dos comandos, o trace, o
+        histórico e os comandos dos passos executados são gravados no cache.
+        """
+        steps = self._selected_steps(only, skip)
+        # Execuções que só exibem informações não ocupam um dos keep_runs
+        # diretórios de log.
+        if not set(steps) <= set(self.report_steps):
+            OUTPUT_CAPTURE.start(os.path.join(self.cache_dir, "logs"))
+        sampler = None
+        if self.sample_resources is True:
+            sampler = ResourceSampler()
+            sampler.start()
+        results = []
+        try:
+            self._run_steps(steps, progress, results)
+        finally:
+            if sampler is not None:
+                sampler.stop()
+                self.print_resource_report(sampler.report())
+            executed = [result.step for result in results
+                        if result.status == "ok"]
+            self.save_trace(executed)
+            self.probe.save()
+            OUTPUT_CAPTURE.save_metrics()
+        return results
+
+    def _run_steps(self, steps, progress, results):
+        if "set_instalation_path" not in steps:
+            self._set_paths(self._planned_repository_path())
+        if self.batch is True:
+            missing = self._missing_answers(steps)
+            if missing:
+                msg = "Respostas não informadas para o modo não interativo: {}"
+                raise MissingAnswerError(msg.format(", ".join(missing)))
+        if progress is None:
+            progress = len(steps) > 2
+        if progress is True:
+            estimates = {step: estimate or 0
+                         for step, run_step, _, estimate in self._plan(steps)
+                         if run_step}
+        start = time.time()
+        for index, step in enumerate(steps):
+            run_step, reason = self._precondition(step)
+            if run_step is False:
+                if progress is True:
+                    msg = "[{}/{}] {} pulado: {}"
+                    print_warning(msg.format(index + 1, len(steps), step,
+                                             reason))
+                results.append(StepResult(step, "skipped", reason, 0, None))
+                continue
+            if progress is True:
+                remaining = sum(estimates.get(name, 0)
+                                for name in steps[index:])
+                msg = "[{}/{}] {} | decorrido {} | restante ~{}"
+                msg = msg.format(index + 1, len(steps), step,
+                                 format_duration(time.time() - start),
+                                 format_duration(remaining))
+                print_info(msg, bold=True)
+            step_start = time.time()
+            value = getattr(self, step)()
+            results.append(StepResult(step, "ok", reason,
+                                      time.time() - step_start, value))
 
 def add_user_to_group(username, group):
     """
@@ -1091,6 +4377,16 @@ def get_additional_groups_name(username):
     groups = [grp.getgrgid(gid).gr_name for gid in groups_id]
     return groups
 
+def psql_version():
+    """
+    Retorna a versão do psql instalado.
+    """
+    cmd = ["bash", "-c"]
+    cmd.append("psql --version")
+    ret = subprocess.check_output(cmd).decode("utf-8")
+    ret = ret.replace("psql", "").replace("(PostgreSQL)", "")
+    return ret.replace("\n", "").strip()
+
 def get_file_gid(filepath):
     """
     Retorna o gid de filepath.
@@ -1107,6 +4403,66 @@ def get_file_group(filepath):
     group = grp.getgrgid(gid)[0]
     return group
 
+def write_atomic(filepath, content, mode=None):
+    """
+    Grava content em filepath de forma atômica.
+
+    O conteúdo é gravado em um arquivo temporário no mesmo diretório e então
+    renomeado, assim o arquivo nunca é lido pela metade. As permissões do
+    arquivo original são preservadas quando mode não é informado.
+    """
+    if mode is None:
+        try:
+            mode = os.stat(filepath).st_mode & 0o777
+        except OSError:
+            mode = 0o644
+    temporary = filepath + ".prepdev.tmp"
+    with open(temporary, "w") as file_:
+        file_.write(content)
+    os.chmod(temporary, mode)
+    os.replace(temporary, filepath)
+
+def memory_kb():
+    """
+    Retorna a memória total da máquina em KB(None quando indisponível).
+    """
+    try:
+        with open("/proc/meminfo", "r") as meminfo:
+            return int(meminfo.readline().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+def file_hash(filepath):
+    """
+    Retorna o hash sha256 do conteúdo de filepath.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as file_:
+        for chunk in iter(lambda: file_.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def format_duration(seconds):
+    """
+    Formata uma duração em segundos como 1h2m3s.
+    """
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return "{}h{}m{}s".format(hours, minutes, seconds)
+    elif minutes:
+        return "{}m{}s".format(minutes, seconds)
+    return "{}s".format(seconds)
+
+def percentile(values, fraction):
+    """
+    Retorna o percentil(pelo método nearest-rank) dos valores.
+    """
+    ordered = sorted(values)
+    rank = max(math.ceil(fraction * len(ordered)), 1)
+    return ordered[rank - 1]
+
 def print_info(msg, end="\n", bold=False):
     if bold is True:
         print(Colors.BOLD + Colors.GREEN + msg + Colors.ENDC, end=end)
@@ -1142,23 +4498,201 @@ def print_error(msg, end="\n", bold=False):
         print_red(msg, end=end)
 
 
-def call(command, print_output=False):
+def read_processes():
+    """
+    Retorna {pid: campos de /proc/<pid>/stat} de todos os processos.
+    """
+    processes = {}
+    for name in os.listdir("/proc"):
+        if name.isdigit() is False:
+            continue
+        try:
+            with open("/proc/{}/stat".format(name)) as file_:
+                stat = file_.read()
+        except OSError:
+            continue
+        # Os campos após o nome do comando, a partir do estado(campo 3).
+        processes[int(name)] = stat[stat.rfind(")") + 2:].split()
+    return processes
+
+def process_tree(pid):
+    """
+    Retorna os processos(pid: campos do stat) da árvore iniciada em pid.
+    """
+    processes = read_processes()
+    if pid not in processes:
+        return {}
+    children = {}
+    for child, fields in processes.items():
+        children.setdefault(int(fields[1]), []).append(child)
+    tree = {}
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        tree[current] = processes[current]
+        pending += children.get(current, [])
+    return tree
+
+def kill_tree(pid, sig):
+    """
+    Envia sig ao processo pid e a todos os seus descendentes.
+
+    Processos de outro usuário(ex.: iniciados por sudo) são ignorados; o
+    sudo repassa o sinal ao comando que executa.
+    """
+    for child in process_tree(pid):
+        try:
+            os.kill(child, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+def call(command, print_output=False, timeout=None, kill_after=None,
+         record=True, on_line=None):
     """
     Executa um comando de terminal.
+
+    Retorna o código de saída do comando. Com timeout/kill_after o comando
+    é encerrado quando demora demais ou fica sem produzir saída. on_line
+    recebe cada linha da saída enquanto o comando executa.
     """
+    step = STEP_STACK[-1] if STEP_STACK else ""
+    if record is True:
+        COMMAND_LOG.append({"step": step, "command": command})
     cmd = ["bash", "-c"]
     cmd.append(command)
-    if print_output is False:
-        with open(os.devnull, 'w') as fnull:
-            subprocess.call(cmd, stdout=fnull, stderr=subprocess.STDOUT)
-    else:
-        subprocess.call(cmd, stderr=subprocess.STDOUT)
+    master = None
+    stdout = subprocess.PIPE
+    if print_output is True and sys.stdout.isatty():
+        # Um pseudo-terminal preserva as cores e a formatação da saída
+        # exibida.
+        master, stdout = pty.openpty()
+    try:
+        with subprocess.Popen(cmd, stdout=stdout,
+                              stderr=subprocess.STDOUT) as process:
+            with PROCESS_LOCK:
+                PROCESS_STACK.append(process.pid)
+            try:
+                if master is not None:
+                    os.close(stdout)
+                    fd = master
+                else:
+                    fd = process.stdout.fileno()
+                metrics, tail = OUTPUT_CAPTURE.capture(process, fd, step,
+                                                       command, print_output,
+                                                       timeout, kill_after,
+                                                       on_line)
+                returncode = process.wait()
+            finally:
+                with PROCESS_LOCK:
+                    PROCESS_STACK.remove(process.pid)
+    finally:
+        if master is not None:
+            os.close(master)
+    metrics["returncode"] = returncode
+    if returncode != 0 and print_output is False and tail:
+        # Sem a saída na tela, mostra o final dela para diagnosticar o erro.
+        print_error("O comando falhou({}): {}".format(returncode, command))
+        for line in tail:
+            print_red("    " + line)
+    return returncode
+
+def query(sql, database="postgres", quiet=False):
+    """
+    Executa comandos sql no banco de dados e retorna a saída do psql.
+
+    Os comandos são enviados pela entrada padrão, assim cada um é executado
+    em sua própria transação(necessário para CREATE/DROP DATABASE).
+    Com quiet=True os erros do psql não são exibidos.
+    """
+    cmd = ["psql", "-h", "localhost", "-U", "postgres", "-d", database,
+           "-At", "-v", "ON_ERROR_STOP=1"]
+    stderr = subprocess.DEVNULL if quiet is True else None
+    output = subprocess.check_output(cmd, input=sql.encode("utf-8"),
+                                     stderr=stderr)
+    return output.decode("utf-8").strip()
+
+def copy_out(sql, database="postgres"):
+    """
+    Retorna o resultado de sql como uma lista de linhas no formato do COPY.
+
+    Cada linha é uma lista com os campos ainda escapados, prontos para serem
+    reenviados com copy_in.
+    """
+    cmd = ["psql", "-h", "localhost", "-U", "postgres", "-d", database,
+           "-v", "ON_ERROR_STOP=1", "-c", "COPY ({}) TO STDOUT".format(sql)]
+    output = subprocess.check_output(cmd).decode("utf-8")
+    return [line.split("\t") for line in output.split("\n") if line != ""]
+
+def copy_in(table, columns, lines, database="postgres"):
+    """
+    Carrega as linhas(já no formato do COPY) em table.
+    """
+    copy = "COPY {} ({}) FROM STDIN".format(table, ", ".join(columns))
+    cmd = ["psql", "-h", "localhost", "-U", "postgres", "-d", database,
+           "-v", "ON_ERROR_STOP=1", "-c", copy]
+    with subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                          stdout=subprocess.DEVNULL) as psql:
+        for line in lines:
+            psql.stdin.write(line.encode("utf-8"))
+        psql.stdin.close()
+        returncode = psql.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+def migration_version(database, tables=("alembic_version",
+                                         "migrate_version")):
+    """
+    Retorna a versão gravada na tabela de versões das migrações(None quando
+    o banco ainda não tem migrações).
+    """
+    tables = ", ".join("'{}'".format(table) for table in tables)
+    sql = "SELECT quote_ident(table_schema) || '.' || "
+    sql += "quote_ident(table_name) FROM information_schema.tables "
+    sql += "WHERE table_name IN ({}) LIMIT 1".format(tables)
+    table = query(sql, database, quiet=True)
+    if table == "":
+        return None
+    sql = "SELECT string_agg(v::text, ',') FROM {} v".format(table)
+    return query(sql, database, quiet=True)
+
+def split_sql(sql):
+    """
+    Divide um script sql em comandos.
+
+    Strings, comentários e blocos $$ não são divididos e cada COPY ... FROM
+    stdin inclui os seus dados(até a linha \\.).
+    """
+    statements = []
+    current = ""
+    position = 0
+    while position < len(sql):
+        match = SQL_TOKEN.match(sql, position)
+        current += match.group(0)
+        position = match.end()
+        if match.group(0) != ";":
+            continue
+        if SQL_COPY_FROM_STDIN.match(current) is not None:
+            end = SQL_COPY_END.search(sql, position)
+            end = end.end() if end is not None else len(sql)
+            current += sql[position:end]
+            position = end
+        statements.append(current)
+        current = ""
+    if current.strip():
+        statements.append(current)
+    return statements
 
 def format_cmd_print(cmd, help):
     msg = Colors.BLUE + Colors.BOLD + cmd + Colors.ENDC + Colors.GREEN
     msg += " => " + help
     return msg
 
+def step_list(value):
+    """
+    Converte uma lista de passos separados por vírgula.
+    """
+    return [step.strip() for step in value.split(",") if step.strip()]
+
 def configure_parseargs():
     """
     Configura os parâmetros do comando.
@@ -1198,17 +4732,219 @@ def configure_parseargs():
                         dest='sigma_help',
                         action='store_true',
                         help=help_text)
+    help_text = "Cria N cópias numeradas do banco de desenvolvimento para "
+    help_text += "execução paralela dos testes."
+    parser.add_argument('--test-databases',
+                        '-t',
+                        dest='test_databases',
+                        type=int,
+                        default=0,
+                        action='store',
+                        help=help_text)
+    help_text = "Exclui todas as cópias do banco criadas para testes."
+    parser.add_argument('--drop-test-databases',
+                        dest='drop_test_databases',
+                        action='store_true',
+                        help=help_text)
+    help_text = "Restaura somente os dados do schema informado, sem excluir "
+    help_text += "o banco de dados."
+    parser.add_argument('--reset-schema',
+                        dest='reset_schema',
+                        type=str,
+                        default="",
+                        choices=list(INTERPOLATION_VALUES["schemas"]),
+                        action='store',
+                        help=help_text)
+    help_text = "Multiplica os dados de desenvolvimento por N com dados "
+    help_text += "sintéticos(teste de carga)."
+    parser.add_argument('--data-scale',
+                        dest='data_scale',
+                        type=int,
+                        default=0,
+                        action='store',
+                        help=help_text)
+    help_text = "Imprime as estatísticas(p50/p95) de duração de cada passo "
+    help_text += "e indica os passos com regressão."
+    parser.add_argument('--stats',
+                        dest='stats',
+                        action='store_true',
+                        help=help_text)
+    help_text = "Razão entre a última duração e a mediana anterior a partir "
+    help_text += "da qual um passo é considerado uma regressão."
+    parser.add_argument('--regression-threshold',
+                        dest='regression_threshold',
+                        type=float,
+                        default=1.5,
+                        action='store',
+                        help=help_text)
+    help_text = "Imprime os passos que serão executados/pulados e a duração "
+    help_text += "estimada de cada um, sem executá-los."
+    parser.add_argument('--plan',
+                        dest='show_plan',
+                        action='store_true',
+                        help=help_text)
+    help_text = "Verifica todas as pré-condições de uma só vez. Retorna 0 "
+    help_text += "quando nenhum problema é encontrado."
+    parser.add_argument('--doctor',
+                        dest='run_doctor',
+                        action='store_true',
+                        help=help_text)
+    help_text = "Modo não interativo: as perguntas são respondidas pelo "
+    help_text += "arquivo de respostas/--answer e a falta de uma resposta "
+    help_text += "interrompe a execução."
+    parser.add_argument('--batch',
+                        dest='batch',
+                        action='store_true',
+                        help=help_text)
+    help_text = "Arquivo com as respostas das perguntas(seção [answers]). "
+    help_text += "Chaves: repository_path, drop_database, populate_db, "
+    help_text += "pg_hba_configured, postgresql_version, postgresql_cluster."
+    parser.add_argument('--answers',
+                        dest='answers_file',
+                        type=str,
+                        default="",
+                        action='store',
+                        help=help_text)
+    help_text = "Resposta de uma pergunta no formato chave=valor. Pode ser "
+    help_text += "repetido e tem precedência sobre o arquivo de respostas."
+    parser.add_argument('--answer',
+                        dest='answers',
+                        type=str,
+                        default=[],
+                        action='append',
+                        help=help_text)
+    help_text = "Exporta o último provisionamento completo como um contexto "
+    help_text += "de build(Dockerfile) no diretório informado."
+    parser.add_argument('--export-container',
+                        dest='export_dir',
+                        type=str,
+                        default="",
+                        action='store',
+                        help=help_text)
+    help_text = "Imagem base do Dockerfile gerado por --export-container."
+    parser.add_argument('--base-image',
+                        dest='base_image',
+                        type=str,
+                        default="debian:jessie",
+                        action='store',
+                        help=help_text)
+    help_text = "Observa as migrações e os dados de desenvolvimento e os "
+    help_text += "reaplica a cada alteração."
+    parser.add_argument('--watch',
+                        '-w',
+                        dest='watch',
+                        action='store_true',
+                        help=help_text)
+    help_text = "Executa somente os passos informados(separados por vírgula)."
+    parser.add_argument('--only',
+                        dest='only',
+                        type=step_list,
+                        default=[],
+                        action='store',
+                        help=help_text)
+    help_text = "Não executa os passos informados(separados por vírgula)."
+    parser.add_argument('--skip',
+                        dest='skip',
+                        type=step_list,
+                        default=[],
+                        action='store',
+                        help=help_text)
+    help_text = "Aplica ao cluster um perfil de tuning para desenvolvimento "
+    help_text += "(arquivo próprio no conf.d, aplicado com reload)."
+    parser.add_argument('--tune-postgresql',
+                        dest='tune_postgresql',
+                        action='store_true',
+                        help=help_text)
+    help_text = "Remove o perfil de tuning aplicado por --tune-postgresql."
+    parser.add_argument('--untune-postgresql',
+                        dest='untune_postgresql',
+                        action='store_true',
+                        help=help_text)
+    help_text = "Diretório com sigma.bundle e sigmalib.bundle(git bundle) "
+    help_text += "usados para clonar os repositórios sem acesso à rede."
+    parser.add_argument('--bundle-dir',
+                        dest='bundle_dir',
+                        type=str,
+                        default="",
+                        action='store',
+                        help=help_text)
+    help_text = "Gera os git bundles dos repositórios locais no diretório "
+    help_text += "informado."
+    parser.add_argument('--create-bundles',
+                        dest='bundles_output',
+                        type=str,
+                        default="",
+                        action='store',
+                        help=help_text)
+    help_text = "Amostra cpu, memória, disco, rede e atividade do postgresql "
+    help_text += "durante a execução e aponta o gargalo de cada passo."
+    parser.add_argument('--sample-resources',
+                        dest='sample_resources',
+                        action='store_true',
+                        help=help_text)
+    help_text = "Número de conexões usadas para carregar os dados de "
+    help_text += "desenvolvimento. Acima de 1 os arquivos independentes são "
+    help_text += "carregados em paralelo(padrão: 1, carga sequencial)."
+    parser.add_argument('--seed-jobs',
+                        dest='seed_jobs',
+                        type=int,
+                        default=1,
+                        action='store',
+                        help=help_text)
+    help_text = "Remove os índices secundários e as chaves estrangeiras "
+    help_text += "durante a carga dos dados de desenvolvimento e os recria "
+    help_text += "ao final."
+    parser.add_argument('--defer-constraints',
+                        dest='defer_constraints',
+                        action='store_true',
+                        help=help_text)
+    help_text = "Carrega no cache do postgresql(pg_prewarm) as relações "
+    help_text += "mais acessadas após a carga dos dados."
+    parser.add_argument('--prewarm',
+                        dest='prewarm',
+                        action='store_true',
+                        help=help_text)
     return parser.parse_args()
 
 if __name__ == "__main__":
+    if apt is None:
+        print_apt_not_found()
+        sys.exit(-1)
     args = configure_parseargs()
-    instance = Prepdev(resetdb=args.resetdb,
-                       excludedb=args.excludedb,
-                       close_connections=args.close_connections,
-                       repository_path=args.repository_path,
-                       sigma_help=args.sigma_help)
     try:
-        instance.run()
+        instance = Prepdev(resetdb=args.resetdb,
+                           excludedb=args.excludedb,
+                           close_connections=args.close_connections,
+                           repository_path=args.repository_path,
+                           sigma_help=args.sigma_help,
+                           test_databases=args.test_databases,
+                           drop_test_databases=args.drop_test_databases,
+                           reset_schema=args.reset_schema,
+                           data_scale=args.data_scale,
+                           stats=args.stats,
+                           regression_threshold=args.regression_threshold,
+                           show_plan=args.show_plan,
+                           run_doctor=args.run_doctor,
+                           batch=args.batch,
+                           answers_file=args.answers_file,
+                           answers=args.answers,
+                           export_dir=args.export_dir,
+                           base_image=args.base_image,
+                           watch=args.watch,
+                           only=args.only,
+                           skip=args.skip,
+                           tune_postgresql=args.tune_postgresql,
+                           untune_postgresql=args.untune_postgresql,
+                           bundle_dir=args.bundle_dir,
+                           bundles_output=args.bundles_output,
+                           sample_resources=args.sample_resources,
+                           seed_jobs=args.seed_jobs,
+                           defer_constraints=args.defer_constraints,
+                           prewarm=args.prewarm)
+        sys.exit(instance.run())
+    except (MissingAnswerError, InvalidStepError) as exc:
+        print_error(str(exc), bold=True)
+        sys.exit(2)
     except PermissionError as exc:
         if "pg_hba.conf" in exc.filename:
             msg = "Não consegui acessar o arquivo " + Colors.BLUE + "{}"